@@ -0,0 +1,100 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from PIL import Image
+
+# Gallery images, read from disk once and then served from memory.
+#
+# Every upload gets its own BytesIO over the cached bytes. CPython shares the
+# underlying buffer until someone writes to it, so handing those out copies nothing.
+#
+# PNGs over a size limit can be shrunk to fit a maximum dimension and re-encoded
+# as WebP when first loaded. That keeps transparency but is a fraction of the size.
+
+class Asset(NamedTuple):
+    data: bytes
+    # File extension to upload it with, including the dot
+    ext: str
+
+class AssetCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, transcode_over: int = 128 * 1024, max_dimension: int = 512):
+        self.max_bytes = max_bytes
+        # PNGs bigger than this many bytes get transcoded, None to never transcode
+        self.transcode_over = transcode_over
+        self.max_dimension = max_dimension
+
+        # path -> Asset, least recently used first
+        self.assets = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Loads happen on executor threads, while lookups happen on the event loop
+        self.lock = threading.Lock()
+
+    # The cached asset for a path, or None without touching the disk
+    def peek(self, path: str):
+        with self.lock:
+            asset = self.assets.get(path)
+            if asset is not None:
+                self.assets.move_to_end(path)
+                self.hits += 1
+            return asset
+
+    # The asset for a path, reading it from disk if it isn't cached. Blocks on
+    # disk I/O, so call it from an executor.
+    def load(self, path: str) -> Asset:
+        asset = self.peek(path)
+        if asset is not None:
+            return asset
+
+        with open(path, "rb") as f:
+            data = f.read()
+        asset = Asset(data, os.path.splitext(path)[1].lower())
+        if asset.ext == ".png" and self.transcode_over is not None and len(data) > self.transcode_over:
+            asset = self.transcode(data)
+
+        with self.lock:
+            self.misses += 1
+            if path not in self.assets:
+                self.assets[path] = asset
+                self.size += len(asset.data)
+            while self.size > self.max_bytes and len(self.assets) > 1:
+                _, evicted = self.assets.popitem(last=False)
+                self.size -= len(evicted.data)
+        return asset
+
+    def transcode(self, data: bytes) -> Asset:
+        with Image.open(io.BytesIO(data)) as im:
+            im.thumbnail((self.max_dimension, self.max_dimension))
+            out = io.BytesIO()
+            im.save(out, format="WEBP", quality=90)
+        return Asset(out.getvalue(), ".webp")
+
+    # Load everything given up front, as far as the budget allows
+    def warm(self, paths):
+        for path in paths:
+            try:
+                # Don't churn the cache once it's full
+                if self.size + os.path.getsize(path) > self.max_bytes:
+                    break
+                self.load(path)
+            except OSError:
+                pass
+
+    # Drop a path whose file has changed, so it's read again next time
+    def forget(self, path: str):
+        with self.lock:
+            asset = self.assets.pop(path, None)
+            if asset is not None:
+                self.size -= len(asset.data)
+
+    def stats(self) -> dict:
+        return {
+            "bytes": self.size,
+            "entries": len(self.assets),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import bot as botmod
+from assets import AssetCache
+from db import AsyncDB
+from fakecord import FakeBot, FakeContext, FakeForumChannel, FakeGuild, FakeReactionEvent, FakeTextChannel, Network
+
+# Times whole rounds, /start through voting to /stop, against fakecord instead
+# of Discord, for a range of round sizes and catalogue sizes.
+#
+# For every (catalogue, round size) it reports the median wall time of /start
+# and /stop, how many HTTP requests each made, and how many commits each made
+# to the database. Add latency and 429s to see how the cog copes with a slow
+# or grumpy Discord:
+#
+#     python bench.py --catalogues 200,50000 --latency 0.05 --rate-limit 0.02
+#
+# With --guilds N, every round runs in N guilds at once, each with its own
+# channels, and the times are for all of them together.
+#
+# Reactions are paced by ReactionScheduler, which by default waits a quarter
+# second between them - that dwarfs everything else, so it's off unless asked
+# for with --reaction-interval 0.25.
+
+TAGS = [f"{cost}-Cost" for cost in range(1, 7)] + ["Map", "Card Sleeve"]
+
+# Writes manifests and a gallery for a made up catalogue of n things, mostly cards
+def make_catalogue(path: str, n: int):
+    cards = max(1, n * 8 // 10)
+    maps = max(1, n // 10)
+    sleeves = max(1, n - cards - maps)
+    gallery = os.path.join(path, "gallery")
+    os.makedirs(gallery)
+
+    Image.new("RGB", (90, 128), (200, 80, 80)).save(os.path.join(path, "card.jpg"), quality=80)
+    Image.new("RGBA", (128, 128), (80, 80, 200, 255)).save(os.path.join(path, "other.png"))
+
+    manifests = {
+        "manifest.json": {str(i): {"name": f"Card {i}", "rarity": "Common", "cost": 1 + i % 6} for i in range(1, cards + 1)},
+        "mapifest.json": {str(i): {"name": f"Map {i}"} for i in range(1, maps + 1)},
+        "sleeve_manifest.json": {str(i): {"name": f"Sleeve {i}"} for i in range(sleeves)},
+    }
+    for fname, manifest in manifests.items():
+        with open(os.path.join(path, fname), "w") as f:
+            f.write(json.dumps(manifest))
+
+    # Every image is the same one, hard linked, so this stays quick at 50k
+    for i in range(1, cards + 1):
+        os.link(os.path.join(path, "card.jpg"), os.path.join(gallery, f"{i}.jpg"))
+    for i in range(1, maps + 1):
+        os.link(os.path.join(path, "other.png"), os.path.join(gallery, f"map_{i}.png"))
+    for i in range(sleeves):
+        os.link(os.path.join(path, "other.png"), os.path.join(gallery, f"sleeve_{i}.png"))
+
+# Counts COMMITs on the writer connection
+class CommitCounter:
+    def __init__(self, db: AsyncDB):
+        self.commits = 0
+        self.statements = 0
+        db.writer.submit(db.db.conn.set_trace_callback, self.trace).result()
+
+    def trace(self, sql: str):
+        self.statements += 1
+        if sql.strip().upper().startswith("COMMIT"):
+            self.commits += 1
+
+    def reset(self):
+        self.commits = 0
+        self.statements = 0
+
+# Everyone votes on every message of the round, a random score each
+async def vote(cog, channel: FakeTextChannel, voters: int, max_vote: int):
+    for message in list(channel.messages.values()):
+        if not message.reacted:
+            continue
+        for user_id in range(1, voters + 1):
+            emoji = botmod.reactions(max_vote)[random.randrange(max_vote)]
+            message.react(user_id, emoji)
+            await cog.on_raw_reaction_add(FakeReactionEvent(message, user_id, emoji))
+
+async def bench_catalogue(n: int, args) -> list:
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    try:
+        make_catalogue(tmp, n)
+        t = time.perf_counter()
+        db = AsyncDB(
+            os.path.join(tmp, "data.db"),
+            os.path.join(tmp, "manifest.json"),
+            os.path.join(tmp, "mapifest.json"),
+            os.path.join(tmp, "sleeve_manifest.json"),
+            os.path.join(tmp, "gallery"),
+        )
+        boot = time.perf_counter() - t
+
+        net = Network(args.latency, args.jitter, args.rate_limit, seed=args.seed)
+        bot = FakeBot(net)
+        cog = botmod.Poller(bot, db, True, False, os.path.join(tmp, "atlas"), AssetCache(), os.path.join(tmp, "diff.json"))
+        cog.reactions.interval = args.reaction_interval
+        # (guild, voting channel) for each guild
+        guilds = []
+        for _ in range(args.guilds):
+            guild = FakeGuild()
+            forum = bot.add_channel(FakeForumChannel(net, tags=TAGS))
+            guilds.append((guild, bot.add_channel(FakeTextChannel(net))))
+            await db.set_forum_chan(guild.id, forum.id)
+        commits = CommitCounter(db)
+        max_vote = botmod.max_vote_for(args.type)
+
+        rows = []
+        for size in args.sizes:
+            samples = []
+            for _ in range(args.rounds):
+                net.reset()
+                commits.reset()
+                t = time.perf_counter()
+                await asyncio.gather(*[cog.start.callback(cog, FakeContext(votes, guild), size, args.type) for guild, votes in guilds])
+                start = (time.perf_counter() - t, net.total(), commits.commits)
+
+                for _, votes in guilds:
+                    await vote(cog, votes, args.voters, max_vote)
+
+                net.reset()
+                commits.reset()
+                t = time.perf_counter()
+                await asyncio.gather(*[cog.stop.callback(cog, FakeContext(votes, guild)) for guild, votes in guilds])
+                stop_ms = time.perf_counter() - t
+                # Cleanup happens after /stop answers, but its requests and commits still count
+                await cog.cleanup.drain()
+                stop = (stop_ms, net.total(), commits.commits)
+                samples.append((start, stop, net.rate_limited))
+
+            rows.append({
+                "catalogue": n,
+                "size": size,
+                "boot_ms": boot * 1000,
+                "start_ms": statistics.median(s[0][0] for s in samples) * 1000,
+                "stop_ms": statistics.median(s[1][0] for s in samples) * 1000,
+                "start_http": statistics.median(s[0][1] for s in samples),
+                "stop_http": statistics.median(s[1][1] for s in samples),
+                "start_commits": statistics.median(s[0][2] for s in samples),
+                "stop_commits": statistics.median(s[1][2] for s in samples),
+                "rate_limited": sum(s[2] for s in samples),
+            })
+        db.close()
+        return rows
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def parse_sizes(s: str):
+    if "-" in s:
+        lo, hi = s.split("-")
+        return list(range(int(lo), int(hi) + 1))
+    return [int(x) for x in s.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark whole rounds against a fake Discord.")
+    parser.add_argument("--catalogues", default="200,5000,50000", help="catalogue sizes, comma separated")
+    parser.add_argument("--sizes", default="1-6", help="round sizes, e.g. 1-6 or 2,4")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds per size, the median is reported")
+    parser.add_argument("--type", default="card", choices=["card", "map", "sleeve"])
+    parser.add_argument("--voters", type=int, default=20)
+    parser.add_argument("--guilds", type=int, default=1, help="guilds running rounds at the same time")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per request")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="chance of a 429 per request")
+    parser.add_argument("--reaction-interval", type=float, default=0.0, help="ReactionScheduler pacing, 0.25 in production")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print rows as JSON lines instead of a table")
+    args = parser.parse_args()
+    args.sizes = parse_sizes(args.sizes)
+    random.seed(args.seed)
+
+    header = f"{'catalogue':>9} {'size':>4} {'boot ms':>8} {'start ms':>9} {'stop ms':>8} {'start http':>10} {'stop http':>9} {'start commits':>13} {'stop commits':>12} {'429s':>5}"
+    if not args.json:
+        print(header)
+    for n in [int(x) for x in args.catalogues.split(",")]:
+        for row in asyncio.run(bench_catalogue(n, args)):
+            if args.json:
+                print(json.dumps(row))
+                continue
+            print(f"{row['catalogue']:>9} {row['size']:>4} {row['boot_ms']:>8.1f} {row['start_ms']:>9.1f} {row['stop_ms']:>8.1f} "
+                  f"{row['start_http']:>10} {row['stop_http']:>9} {row['start_commits']:>13} {row['stop_commits']:>12} {row['rate_limited']:>5}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
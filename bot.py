@@ -1,17 +1,38 @@
 import asyncio
-from math import ceil, floor
-from threading import Lock
+import io
+import json
+import os
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
 import itertools
 
 import discord
-from discord.ext import commands
-
-from db import DB
+from discord.ext import commands, tasks
+
+import metrics
+from assets import AssetCache
+from cleanup import CleanupWorker
+from db import AsyncDB
+from export import FORMATS, export
+from ratelimit import ReactionScheduler
+from render import Atlas, render
+from rounds import Busy, RoundCoordinator
+from scoring import weighted_average
+from tally import TallyEngine
+from tierlist import TierCache
 
 intents = discord.Intents.default()
 bot = discord.Bot(intents = intents)
 
+# The bot to run: `bot`, or with sharded set, an AutoShardedBot which spreads
+# guilds over as many gateway connections as Discord recommends (or shard_count).
+# Everything the cog keeps is per guild or per channel either way.
+def make_bot(sharded: bool = False, shard_count: int = None) -> discord.Bot:
+    if not sharded:
+        return bot
+    return discord.AutoShardedBot(intents = intents, shard_count = shard_count)
+
 forumDescription = {
     "sleeve": "Discuss how this card sleeve would be placed into the tier list! Assuming this sleeve is used on a Tableturf Battle deck in-game. Factors which contribute to this include how unique is the sleeve design wise, (is it copy pasted from another sleeve?) visual appeal, contrast, color theory/balance, saturation, and theming. (how well do you think the character/concept is represented in the sleeve)",
     "card": "Discuss how this normal card would be placed into the tier list! Assuming how easily it can be used in general or placed into a deck. Factors which contribute to this include offense, (poking/piercing, flanking, winning clashes, good special tile placement so you can easily special attack from it later) defense, (blocking, establishing routes, map control/occupying space, good normal/special tile placement so it isn't easily special attacked over later) openings, (meaning its played on the 1st turn) special building, (combo ability, how easy is it to activate the card's special point) special attacks, (this can be considered for all aspects of the match which is early/mid/endgame) its ability to be played at any time, (wont be a brick/unusable past a specific point) and finally the niche situations that it would be usable in if thats applicable. Which is described in the voting channel. (Note that every map is considered in discussions except for Box Seats)",
@@ -20,6 +41,26 @@ forumDescription = {
 
 highest_possible_vote = 10
 
+# How long a queued command waits for the channel before giving up, in seconds
+queue_timeout = 60
+
+# How often live vote counts are saved to the database, in seconds
+tally_checkpoint_interval = 60
+
+# How many Discord requests starting a round keeps in flight at once
+launch_concurrency = 4
+
+# How many Discord requests deleting old messages and locking threads keeps in flight at once
+cleanup_concurrency = 4
+
+busy_message = "Something is already happening in this channel, try again in a moment."
+
+# How often metrics are written to metrics_json_path, when it's set, in seconds
+metrics_dump_interval = 60
+
+# Biggest export /export attaches when Discord doesn't say, in bytes
+export_attach_limit = 8 * 1024 * 1024
+
 def reactions(n):
     if n > highest_possible_vote:
         raise ValueError("Only <{highest_possible_vote} are supported")
@@ -41,13 +82,293 @@ def score_from_reaction_name(name: str) -> Optional[int]:
         s = 10
     return s
 
+def max_vote_for(type: str) -> int:
+    if type != "card":
+        return 5
+    return 10
+
+# The forum tag a round's threads get
+def tags_for(forum_ch: discord.ForumChannel, type: str, cost=None):
+    for tag in forum_ch.available_tags:
+        if type == "card":
+            if tag.name == f"{cost}-Cost":
+                return [tag]
+        elif type == "map":
+            if tag.name == "Map":
+                return [tag]
+        else:
+            if tag.name == "Card Sleeve":
+                return [tag]
+    return []
+
+# Who reacted with what on a message, as {user id: {scores}}.
+# This pages through every reaction's users, so it's only for catching up.
+async def voters_from_message(msg: discord.Message, max_vote: int, own_id: int):
+    present = {}
+    for r in msg.reactions:
+        score = score_from_reaction_name(r.emoji)
+        if score is None or score > max_vote:
+            continue
+        async for user in r.users():
+            if user.id != own_id:
+                present.setdefault(user.id, set()).add(score)
+    return present
+
+def read_json(path: str):
+    with open(path) as f:
+        return json.loads(f.read())
+
+# Vote counts straight off a message's reactions.
+# Someone reacting with several keycaps counts several times here, so this is
+# only for messages we missed the reactions on.
+def scores_from_message(msg: discord.Message, max_vote: int):
+    scores = [0]*max_vote
+    for r in msg.reactions:
+        score = score_from_reaction_name(r.emoji)
+        if score is None or score > max_vote:
+            continue
+        # Be sure to remove our own reaction
+        scores[score-1] = r.count - 1
+    return scores
+
 class Poller(commands.Cog):
-    def __init__(self, bot: discord.Bot, db: DB, should_delete_messages: bool):
+    def __init__(self, bot: discord.Bot, db: AsyncDB, should_delete_messages: bool, queue_busy_commands: bool, atlas_path: str, assets: AssetCache, diff_path: str,
+                 metrics_port: int = None, metrics_json_path: str = None, export_path: str = "exports"):
         self.bot = bot
         self.db = db
+        self.assets = assets
         self.should_delete_messages = should_delete_messages
-        self.mutex = Lock()
-        self.in_progress = False
+        self.queue_busy_commands = queue_busy_commands
+        self.atlas_path = atlas_path
+        self.atlas = None
+        self.atlas_lock = asyncio.Lock()
+        self.diff_path = diff_path
+        self.export_path = export_path
+        self.rounds = RoundCoordinator()
+        self.reactions = ReactionScheduler()
+        self.cleanup = CleanupWorker(cleanup_concurrency)
+        self.tally = TallyEngine()
+        self.tiers = TierCache(db)
+        # on_ready fires again on every reconnect, but catching up only wants doing once
+        self.caught_up = False
+        self.checkpoint_tallies.change_interval(seconds=tally_checkpoint_interval)
+
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.metrics_json_path = metrics_json_path
+        self.dump_metrics.change_interval(seconds=metrics_dump_interval)
+        self.profiler = metrics.Profiler()
+        metrics.gauge("reactions", self.reactions.stats, label="stat")
+        metrics.gauge("image_cache", self.assets.stats, label="stat")
+        metrics.gauge("cleanup", self.cleanup.stats, label="stat")
+        metrics.gauge("tracked_messages", lambda: len(self.tally.things))
+        metrics.gauge("rounds_in_progress", lambda: len(self.rounds.in_progress))
+
+    def cog_unload(self):
+        self.checkpoint_tallies.cancel()
+        self.dump_metrics.cancel()
+        self.profiler.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not self.checkpoint_tallies.is_running():
+            self.checkpoint_tallies.start()
+        if self.metrics_json_path and not self.dump_metrics.is_running():
+            self.dump_metrics.start()
+        # With lazy loading this is where the catalogue gets built, off the event loop
+        catalogue = await self.db.load_catalogue()
+        # Get every image into memory in the background, so rounds don't wait on the disk
+        paths = [self.db.img_path(e.number, e.type) for type in ["card", "map", "sleeve"] for e in catalogue.all(type)]
+        asyncio.get_running_loop().run_in_executor(None, self.assets.warm, paths)
+        if not self.caught_up:
+            self.caught_up = True
+            await self.recover_rounds()
+            # Threads a /stop handed off but which never got locked
+            self.cleanup.lock_threads(self.get_thread, await self.db.get_forum_posts("locking"), self.db.remove_forum_posts)
+            await self.hydrate_tallies()
+        # Last, so not being able to serve metrics can't get in the way of anything that matters
+        if self.metrics_port and self.metrics_server is None:
+            try:
+                self.metrics_server = await metrics.serve(port=self.metrics_port)
+            except OSError as e:
+                print(f"Couldn't serve metrics on port {self.metrics_port}: {e!r}")
+
+    # Rounds a crash cut short while starting are still in the journal. Each is
+    # finished off from where it got to, all of them at once. If there's
+    # nowhere left to finish one, whatever it did post is deleted instead.
+    #
+    # If Discord fails it while posting, the round is taken down and dropped,
+    # just like a /start that fails. Anything else that fails stays in the
+    # journal for the next start.
+    async def recover_rounds(self):
+        journal = await self.db.get_journal()
+        if not journal:
+            return
+
+        async def recover(round_id, guild_id, channel_id, type, numbers, done):
+            async with self.rounds.hold(channel_id, wait=True):
+                # Whoever held the channel before us may have been a /start
+                # finishing this very round, so go by the journal as it is now
+                entry = next((entry for entry in await self.db.get_journal() if entry[0] == round_id), None)
+                if entry is None:
+                    return
+                numbers, done = entry[4], entry[5]
+                with metrics.span("recover_round"):
+                    ch = self.bot.get_channel(channel_id)
+                    forum_ch_id = await self.db.get_forum_chan(guild_id)
+                    forum_ch = self.bot.get_channel(forum_ch_id) if forum_ch_id is not None else None
+                    if ch is None or forum_ch is None:
+                        await self.clean_up_round(ch, done, numbers)
+                        await self.db.drop_round(round_id)
+                        return
+
+                    # Things since removed by /sync can't be finished, only cleaned up
+                    things = [self.db.catalogue.get(type, n) if self.db.catalogue.is_current(type, n) else None for n in numbers]
+                    await self.clean_up_round(ch, done, [n for n, thing in zip(numbers, things) if thing is None])
+                    things = [thing for thing in things if thing is not None]
+
+                    self.rounds.in_progress.add(channel_id)
+                    tags = tags_for(forum_ch, type, things[0].cost if things and type == "card" else None)
+                    try:
+                        msgs, forum_posts, missing = await self.post_round(round_id, ch, forum_ch, things, type, tags, done)
+                    except Exception:
+                        await self.abandon_round(round_id, ch)
+                        raise
+                    await self.report_missing(ch, things, type, missing)
+                    await self.db.commit_round(round_id, channel_id, type, msgs, forum_posts)
+
+        results = await asyncio.gather(*[recover(*entry) for entry in journal], return_exceptions=True)
+        for entry, result in zip(journal, results):
+            if isinstance(result, Exception):
+                print(f"Couldn't recover round {entry[0]} in <#{entry[2]}>: {result!r}")
+
+    # Takes down whatever a round which failed to start got posted, and drops
+    # it from the journal so its things can be picked again. Left in the
+    # journal, the next start would post it into a channel which has most
+    # likely moved on to another round by then.
+    async def abandon_round(self, round_id, ch):
+        entry = next((entry for entry in await self.db.get_journal() if entry[0] == round_id), None)
+        if entry is not None:
+            numbers, done = entry[4], entry[5]
+            for (number, step), ref_id in done.items():
+                if step == "message_sent":
+                    self.tally.forget(ref_id)
+            try:
+                await self.clean_up_round(ch, done, numbers)
+            except Exception as e:
+                # Whatever's left is just clutter, it isn't counted anywhere
+                print(f"Couldn't clean up round {round_id}: {e!r}")
+        await self.db.drop_round(round_id)
+        self.rounds.in_progress.discard(ch.id)
+
+    # Deletes the messages and threads the journal says were posted for `numbers`.
+    # Already gone is fine, so this is safe to repeat.
+    async def clean_up_round(self, ch, done, numbers):
+        numbers = set(numbers)
+
+        async def delete_message(id):
+            try:
+                # No need to fetch it just to delete it
+                await ch.get_partial_message(id).delete()
+            except discord.NotFound:
+                pass
+
+        async def delete_thread(id):
+            try:
+                await (await self.bot.fetch_channel(id)).delete()
+            except discord.NotFound:
+                pass
+
+        deleting = []
+        for (number, step), ref_id in done.items():
+            if number not in numbers:
+                continue
+            if step == "message_sent" and ch is not None:
+                deleting.append(delete_message(ref_id))
+            elif step == "thread_created":
+                deleting.append(delete_thread(ref_id))
+        await asyncio.gather(*deleting)
+
+    # Pick up counting where we left off: instantly from the last checkpoint,
+    # then corrected from Discord for anything that changed while we were away.
+    async def hydrate_tallies(self):
+        saved = await self.db.get_ballots()
+        msgs = await self.db.get_all_messages()
+        types = {}
+        for channel_id, message_id, number in msgs:
+            if channel_id not in types:
+                types[channel_id] = await self.db.get_round_type(channel_id)
+            type = types[channel_id]
+            self.tally.track(message_id, max_vote_for(type), type, number, saved.get(message_id))
+
+        async def reconcile(channel_id, message_id):
+            ch = self.bot.get_channel(channel_id)
+            if ch is None:
+                return
+            try:
+                msg = await ch.fetch_message(message_id)
+                present = await voters_from_message(msg, max_vote_for(types[channel_id]), self.bot.user.id)
+            except discord.NotFound:
+                # Gone, so let /stop find that out for itself
+                self.tally.forget(message_id)
+                return
+            except discord.HTTPException:
+                return
+            self.tally.reconcile(message_id, present)
+
+        await asyncio.gather(*[reconcile(channel_id, message_id) for channel_id, message_id, _ in msgs])
+
+    # Ballots are written in batches rather than one at a time as people vote
+    @tasks.loop(seconds=60)
+    async def checkpoint_tallies(self):
+        taken, rows = self.tally.take_dirty()
+        if not rows:
+            return
+        try:
+            await self.db.save_ballots(rows)
+        except Exception as e:
+            # They go out with the next checkpoint instead. Raising would stop
+            # the loop for good, e.g. on "database is locked".
+            self.tally.mark_dirty(taken)
+            metrics.inc("checkpoint_failed")
+            print(f"Couldn't checkpoint ballots, trying again next time: {e!r}")
+
+    @tasks.loop(seconds=60)
+    async def dump_metrics(self):
+        await asyncio.get_running_loop().run_in_executor(None, metrics.registry.dump, self.metrics_json_path)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if payload.user_id == self.bot.user.id:
+            return
+        score = score_from_reaction_name(payload.emoji.name)
+        if score is not None:
+            self.tally.add(payload.message_id, payload.user_id, score)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        if payload.user_id == self.bot.user.id:
+            return
+        score = score_from_reaction_name(payload.emoji.name)
+        if score is not None:
+            self.tally.remove(payload.message_id, payload.user_id, score)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        # /stop falls back to fetching it, and will find it missing
+        self.tally.forget(payload.message_id)
+
+    # Runs the block with exclusive access to `key`, either queueing behind
+    # whoever holds it or raising Busy, depending on queue_busy_commands.
+    @asynccontextmanager
+    async def exclusive(self, ctx: discord.ApplicationContext, key):
+        if self.queue_busy_commands and self.rounds.busy(key):
+            # Discord wants an answer within 3 seconds, so acknowledge while we wait our turn
+            await ctx.defer()
+        async with self.rounds.hold(key, wait=self.queue_busy_commands, timeout=queue_timeout):
+            yield
 
     @commands.slash_command()
     @discord.option(
@@ -56,10 +377,112 @@ class Poller(commands.Cog):
     )
     @commands.has_any_role("Whopper")
     async def set_forum_channel(self, ctx: discord.ApplicationContext, channel: discord.ForumChannel):
-        self.mutex.acquire()
-        self.db.set_forum_chan(channel.id)
+        # The forum channel is shared by every round in the guild, so this always queues
+        async with self.rounds.hold(("forum_chan", ctx.guild_id), wait=True):
+            await self.db.set_forum_chan(ctx.guild_id, channel.id)
         await ctx.respond(f"Ok! I will create forum posts in <#{channel.id}> from now on.")
-        self.mutex.release()
+
+    @commands.slash_command(description = "Pick up manifest and gallery changes found by sync.py.")
+    @commands.has_any_role("Whopper")
+    async def sync(self, ctx: discord.ApplicationContext):
+        # A first sync can be the whole catalogue, which takes longer than Discord waits for an answer
+        await ctx.defer(ephemeral=True)
+        loop = asyncio.get_running_loop()
+        # The diff is moved here before it's read, so anything sync.py writes
+        # meanwhile starts a new diff rather than being deleted along with this one
+        claimed = self.diff_path + ".applying"
+
+        lines = []
+        async with self.rounds.hold("sync", wait=True):
+            # One left over from a /sync that didn't finish is older, so it goes
+            # first, then whatever sync.py has written since
+            for claim in [False, True]:
+                if claim:
+                    try:
+                        await loop.run_in_executor(None, os.replace, self.diff_path, claimed)
+                    except FileNotFoundError:
+                        break
+                try:
+                    diff = await loop.run_in_executor(None, read_json, claimed)
+                except FileNotFoundError:
+                    continue
+                counts = await self.db.apply_manifest_diff(diff)
+                for path in diff.get("images", []):
+                    self.assets.forget(path)
+                # Applied, so don't apply it again next time
+                await loop.run_in_executor(None, os.remove, claimed)
+                lines += [f"{typ}: {upserted} added or changed, {removed} removed" for typ, (upserted, removed) in counts.items()]
+                lines.append(f"{len(diff.get('images', []))} images refreshed")
+
+        await ctx.respond("\n".join(lines) or "Nothing to sync, run sync.py first.", ephemeral=True)
+
+    @commands.slash_command(description = "Sample where the bot spends its time, to find out why it's slow.")
+    @discord.option(
+        "action",
+        choices = ["start", "stop"],
+    )
+    @commands.has_any_role("Whopper")
+    async def profile(self, ctx: discord.ApplicationContext, action: str):
+        if action == "start":
+            if self.profiler.running:
+                await ctx.respond("Already profiling, use `/profile stop` to see the results.", ephemeral=True)
+                return
+            # Samples whichever thread calls start, which is the one running the event loop
+            self.profiler.start()
+            await ctx.respond("Profiling. Do the slow thing, then `/profile stop`.", ephemeral=True)
+            return
+
+        if not self.profiler.running:
+            await ctx.respond("Not profiling, use `/profile start` first.", ephemeral=True)
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.profiler.stop)
+        lines = [f"{self.profiler.samples} samples. Most seen running (on stack / running):"]
+        for frame, inclusive, exclusive in self.profiler.top(10):
+            lines.append(f"`{frame}` {inclusive} / {exclusive}")
+        folded = io.BytesIO(self.profiler.folded().encode())
+        await ctx.respond("\n".join(lines)[:2000], file=discord.File(folded, filename="profile.folded"), ephemeral=True)
+
+    @commands.slash_command(description = "Export this server's votes and scores as a file.")
+    @discord.option(
+        "format",
+        choices = FORMATS,
+        default = "csv",
+    )
+    @discord.option(
+        "type",
+        description = "Only export this type.",
+        choices = ["all", "card", "map", "sleeve"],
+        default = "all",
+    )
+    @discord.option(
+        "where",
+        description = "Attach the file here, or just save it on the bot's disk.",
+        choices = ["discord", "disk"],
+        default = "discord",
+    )
+    @commands.has_any_role("Whopper")
+    async def export(self, ctx: discord.ApplicationContext, format: str, type: str, where: str):
+        # Exporting reads a snapshot over its own connection, so it can take its
+        # time without holding up voting
+        await ctx.defer(ephemeral=True)
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.export_path, exist_ok=True)
+        name = f"votes_{ctx.guild_id}_{type}_{time.strftime('%Y%m%d_%H%M%S')}.{format}"
+        path = os.path.join(self.export_path, name)
+        try:
+            with metrics.span("export", format=format):
+                count = await loop.run_in_executor(None, export, self.db.path, path, format, ctx.guild_id, None if type == "all" else [type])
+        except ValueError as e:
+            await ctx.respond(str(e), ephemeral=True)
+            return
+
+        limit = getattr(ctx.guild, "filesize_limit", export_attach_limit)
+        if where == "discord" and os.path.getsize(path) <= limit:
+            await ctx.respond(f"{count} rows.", file=discord.File(path, filename=name), ephemeral=True)
+            await loop.run_in_executor(None, os.remove, path)
+            return
+        note = " It's too big to attach here." if where == "discord" else ""
+        await ctx.respond(f"Wrote {count} rows to `{path}`.{note}", ephemeral=True)
 
     @commands.slash_command()
     @discord.option(
@@ -77,196 +500,360 @@ class Poller(commands.Cog):
     )
     @commands.has_any_role("Whopper")
     async def start(self, ctx: discord.ApplicationContext, size: int, type: str):
-        self.mutex.acquire()
-
-        forum_ch_id = self.db.get_forum_chan()
+        try:
+            async with self.exclusive(ctx, ctx.channel_id):
+                with metrics.span("command", command="start"):
+                    await self.start_round(ctx, size, type)
+        except Busy:
+            metrics.inc("busy", command="start")
+            await ctx.respond(busy_message)
+
+    async def start_round(self, ctx: discord.ApplicationContext, size: int, type: str):
+        forum_ch_id = await self.db.get_forum_chan(ctx.guild_id)
         if forum_ch_id is None:
             await ctx.respond("Please set a forum channel with /set_forum_channel first.")
-            self.mutex.release()
             return
 
         forum_ch = self.bot.get_channel(forum_ch_id)
         if forum_ch is None:
             await ctx.respond("Could not find forum channel - try resetting it?")
-            self.mutex.release()
             return
 
-        if self.in_progress:
+        if ctx.channel_id in self.rounds.in_progress:
             await ctx.respond("A round already in progress.")
-            self.mutex.release()
             return
         
         # If there are messages in the channel, we are in progress
-        if self.db.get_messages(ctx.channel_id):
+        if await self.db.get_messages(ctx.channel_id):
             await ctx.respond("A round already in progress.")
-            self.in_progress = True
-            self.mutex.release()
+            self.rounds.in_progress.add(ctx.channel_id)
             return
         
-        self.in_progress = True
+        self.rounds.in_progress.add(ctx.channel_id)
+        phases = metrics.Phases("start")
 
         if type == "card":
-            await ctx.respond(f"Ok! Starting a new round with at most {size} {self.db.get_lowest_cost()}-cost cards.")
+            cost = await self.db.get_lowest_cost(ctx.guild_id)
+            await ctx.respond(f"Ok! Starting a new round with at most {size} {cost}-cost cards.")
         else:
             await ctx.respond(f"Ok! Starting a new round with at most {size} {type}s.")
 
-        # Delete summaries from the previous round
+        # Delete summaries from the previous round, in the background. They're
+        # only forgotten once deleted, so any that fail get another go next round.
         ch = self.bot.get_channel(ctx.channel_id)
-        for item in self.db.get_summaries(ctx.channel_id):
-            msg = await ch.fetch_message(item[0])
-            if msg is None:
-                self.db.remove_summary(item[0])
-                continue
-            if self.should_delete_messages:
-                await msg.delete()
-            self.db.remove_summary(item[0])
-
-        things = []
-        if type == "card":
-            things = self.db.get_card_group(size)
-        elif type == "map":
-            things = self.db.get_map_group(size)
-        else:
-            things = self.db.get_sleeve_group(size)
+        summaries = [item[0] for item in await self.db.get_summaries(ctx.channel_id)]
+        if self.should_delete_messages:
+            self.cleanup.delete_messages(ch, summaries, self.db.remove_summaries)
+        elif summaries:
+            await self.db.remove_summaries(summaries)
+        phases.mark("cleanup_summaries")
+
+        # Picked and into the journal before anything is posted, so a crash from
+        # here on leaves a record of the round to finish on the next start, and
+        # no other channel can pick the same things meanwhile
+        round_id, things = await self.db.begin_round(ctx.guild_id, ctx.channel_id, type, size)
+        phases.mark("pick")
 
         if not things:
             await ctx.send("There's nothing left to do!")
 
+        # Another channel may have taken the last of that cost since, so go by what was picked
+        tags = tags_for(forum_ch, type, things[0].cost if things and type == "card" else None)
+
+        try:
+            msgs, forum_posts, missing = await self.post_round(round_id, ch, forum_ch, things, type, tags)
+        except Exception:
+            await self.abandon_round(round_id, ch)
+            await ctx.send("Discord had trouble starting the round, so I've called it off. Try again in a bit?")
+            raise
+        phases.mark("post")
+
+        # Let people know if a ballot is incomplete, rather than quietly dropping options
+        await self.report_missing(ctx, things, type, missing)
+
+        await self.db.commit_round(round_id, ctx.channel_id, type, msgs, forum_posts)
+        phases.mark("save")
+
+    # Posts a round's vote messages and forum threads, journalling each step as
+    # it's done. `done` is what the journal already has, {(number, step): ref id},
+    # and anything in it is picked up rather than done again - so this starts a
+    # round from scratch, or finishes one a crash cut short.
+    #
+    # Returns the rows for the messages table, the thread ids, and the
+    # reactions which couldn't be added to each thing's message.
+    async def post_round(self, round_id, channel, forum_ch: discord.ForumChannel, things, type: str, tags, done=None):
+        done = done or {}
+        limit = asyncio.Semaphore(launch_concurrency)
+
+        async def limited(coro):
+            async with limit:
+                return await coro
+
+        # Vote messages and forum posts are two independent chains, run side by side.
+        # Each chain creates its things one after another so they show up in order,
+        # but the slow follow-up work (seeding reactions, attaching images) is
+        # handed off and overlaps with the rest of the chain.
+        #
+        # Everything runs in one TaskGroup, so if any of it fails the rest is
+        # cancelled rather than carrying on posting for a round that's failed.
         msgs = []
         forum_posts = []
-        for thing in things:
-            txt = ""
-            if type == "card":
-                txt = f"No. {thing[0]} {thing[1]} ({thing[2]})"
-            else:
-                txt = thing[1]
-
-
-            # Send message and set reactions on it
-            msg = await ctx.send(
-                txt,
-                file = discord.File(
-                    self.db.get_img(thing[0], type),
-                    filename=thing[1].lower().replace(" ", "_") + ".jpg",
-                ),
-            )
-
-            max_vote = 10
-            if type != "card":
-                max_vote = 5
-
-            pending = []
-            for r in reactions(max_vote):
-                pending.append(msg.add_reaction(discord.PartialEmoji(name=r)))
-            group = asyncio.gather(*pending, return_exceptions=True)
-            await group
-
-            msgs.append((ctx.channel_id, msg.id, thing[0]))
-
-            # Find the relevant tag
-            tags = []
-            for tag in forum_ch.available_tags:
-                if type == "card":
-                    if tag.name == f"{self.db.get_lowest_cost()}-Cost":
-                        tags.append(tag)
-                        break
-                elif type == "map":
-                    if tag.name == "Map":
-                        tags.append(tag)
-                        break
-                else:
-                    if tag.name == "Card Sleeve":
-                        tags.append(tag)
-                        break
-
-            # Create the forum post
-            #
-            # This is a hack. Pycord does not support creating a thread with files directly.
-            # Instead the thread must be created, then edited to add the file.
-            #
-            # See
-            # https://github.com/Pycord-Development/pycord/issues/1948
-            # https://github.com/Pycord-Development/pycord/issues/1949
-            desc = forumDescription[type]
-            thread = await forum_ch.create_thread(
+        # One per thing, in order: the task seeding its reactions, or None if that was already done
+        seeding = []
+
+        async def seed(msg, thing):
+            missing = await self.seed_reactions(msg, type)
+            await self.db.journal_step(round_id, thing[0], "reactions_seeded", msg.id)
+            return missing
+
+        async def attach(thread, thing):
+            await limited(self.attach_image(thread, thing, type))
+            await self.db.journal_step(round_id, thing[0], "file_attached", thread.id)
+
+        async def post_votes(tg: asyncio.TaskGroup):
+            for thing in things:
+                msg = None
+                if (thing[0], "message_sent") in done:
+                    msg = await self.find_message(channel, done[(thing[0], "message_sent")])
+                if msg is None:
+                    msg = await limited(self.post_vote(channel, thing, type))
+                    await self.db.journal_step(round_id, thing[0], "message_sent", msg.id)
+                msgs.append((channel.id, msg.id, thing[0]))
+                self.tally.track(msg.id, max_vote_for(type), type, thing[0])
+                if done.get((thing[0], "reactions_seeded")) == msg.id:
+                    seeding.append(None)
+                    continue
+                # The scheduler does its own pacing, so this doesn't need a slot
+                seeding.append(tg.create_task(seed(msg, thing)))
+
+        async def post_threads(tg: asyncio.TaskGroup):
+            for thing in things:
+                thread = None
+                if (thing[0], "thread_created") in done:
+                    thread = await self.find_thread(done[(thing[0], "thread_created")])
+                if thread is None:
+                    thread = await limited(self.post_thread(forum_ch, thing, type, tags))
+                    await self.db.journal_step(round_id, thing[0], "thread_created", thread.id)
+                forum_posts.append(thread.id)
+                if done.get((thing[0], "file_attached")) == thread.id:
+                    continue
+                tg.create_task(attach(thread, thing))
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(post_votes(tg))
+                tg.create_task(post_threads(tg))
+        except ExceptionGroup as e:
+            # The first failure is the interesting one, the rest were most likely cancelled by it
+            raise e.exceptions[0]
+        # Already seeded means nothing's missing
+        missing = [task.result() if task is not None else [] for task in seeding]
+        return msgs, forum_posts, missing
+
+    async def report_missing(self, dest, things, type: str, missing):
+        missing = [(thing, emojis) for thing, emojis in zip(things, missing) if emojis]
+        if missing:
+            await dest.send("\n".join(
+                ["I couldn't add every reaction, please add these yourselves:"] +
+                [f"{self.db.catalogue.label(type, thing[0])}: {' '.join(emojis)}" for thing, emojis in missing]
+            ))
+
+    # None if it's been deleted
+    async def find_message(self, channel, message_id):
+        try:
+            return await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return None
+
+    async def get_thread(self, thread_id):
+        return self.bot.get_channel(thread_id) or await self.bot.fetch_channel(thread_id)
+
+    async def find_thread(self, thread_id):
+        try:
+            return await self.get_thread(thread_id)
+        except discord.NotFound:
+            return None
+
+    async def thing_file(self, thing, type: str) -> discord.File:
+        path = self.db.img_path(thing[0], type)
+        asset = self.assets.peek(path)
+        if asset is None:
+            with metrics.span("image_read", type=type):
+                asset = await asyncio.get_running_loop().run_in_executor(None, self.assets.load, path)
+        return discord.File(
+            io.BytesIO(asset.data),
+            filename=thing[1].lower().replace(" ", "_") + asset.ext,
+        )
+
+    # Send the message people vote on
+    async def post_vote(self, channel: discord.TextChannel, thing, type: str) -> discord.Message:
+        txt = ""
+        if type == "card":
+            txt = f"No. {thing[0]} {thing[1]} ({thing[2]})"
+        else:
+            txt = thing[1]
+        file = await self.thing_file(thing, type)
+        with metrics.span("discord", op="send_vote"):
+            return await channel.send(txt, file = file)
+
+    # Returns the reactions which couldn't be added
+    async def seed_reactions(self, msg: discord.Message, type: str):
+        max_vote = max_vote_for(type)
+
+        # The scheduler keeps them in order, so the keycaps always show up in order
+        emojis = [discord.PartialEmoji(name=r) for r in reactions(max_vote)]
+        with metrics.span("seed_reactions"):
+            return [e.name for e in await self.reactions.seed(msg, emojis)]
+
+    # Create the forum post
+    #
+    # This is a hack. Pycord does not support creating a thread with files directly.
+    # Instead the thread must be created, then edited to add the file.
+    #
+    # See
+    # https://github.com/Pycord-Development/pycord/issues/1948
+    # https://github.com/Pycord-Development/pycord/issues/1949
+    async def post_thread(self, forum_ch: discord.ForumChannel, thing, type: str, tags) -> discord.Thread:
+        desc = forumDescription[type]
+        with metrics.span("discord", op="create_thread"):
+            return await forum_ch.create_thread(
                 name = thing[1],
                 content = desc,
                 applied_tags = tags,
             )
 
-            forum_posts.append((thread.id,))
-
+    async def attach_image(self, thread: discord.Thread, thing, type: str):
+        with metrics.span("discord", op="fetch_message"):
             message = await thread.fetch_message(thread.id)
-            await message.edit(file=discord.File(
-                    self.db.get_img(thing[0], type),
-                    filename=thing[1].lower().replace(" ", "_") + ".jpg",
-                ))
-        
-        self.db.insert_messages(msgs)
-        self.db.insert_forum_posts(forum_posts)
-        self.db.set_round_type(type)
-        self.mutex.release()
+        file = await self.thing_file(thing, type)
+        with metrics.span("discord", op="attach_image"):
+            await message.edit(file = file)
+
+    @commands.slash_command(description = "Show the tier list so far.")
+    @discord.option(
+        "type",
+        description = "Thing to rank.",
+        choices = ["card", "map", "sleeve"],
+        default = "card",
+    )
+    @discord.option(
+        "mode",
+        description = "How to split things into tiers.",
+        choices = ["thresholds", "quantiles"],
+        default = "thresholds",
+    )
+    @discord.option(
+        "image",
+        description = "Draw it as a picture instead of listing names.",
+        default = False,
+    )
+    async def tierlist(self, ctx: discord.ApplicationContext, type: str, mode: str, image: bool):
+        tiers = await self.tiers.get(ctx.guild_id, type, max_vote_for(type))
+        if not len(tiers):
+            await ctx.respond(f"Nothing has been voted on yet, try again after a round of {type}s.")
+            return
+
+        if image:
+            await ctx.defer()
+            grouped = [(name, [(type, number) for number, _ in things]) for name, things in tiers.tiers(mode)]
+            await ctx.respond(file=discord.File(await self.render_tiers(grouped), filename=f"{type}_tier_list.jpg"))
+            return
+
+        lines = []
+        for name, things in tiers.tiers(mode):
+            labels = [f"{self.db.catalogue.get(type, number).name} ({avg:.2f})" for number, avg in things]
+            lines.append(f"**{name}**: " + (", ".join(labels) if labels else "-"))
+
+        # Discord caps messages at 2000 characters
+        chunks = [""]
+        for line in lines:
+            while line:
+                if len(chunks[-1]) + len(line) + 1 > 2000:
+                    chunks.append("")
+                room = 2000 - len(chunks[-1]) - 1
+                chunks[-1] += ("\n" if chunks[-1] else "") + line[:room]
+                line = line[room:]
+        await ctx.respond(chunks[0])
+        for chunk in chunks[1:]:
+            await ctx.send(chunk)
+
+    # Draws [(tier name, [(type, number), ...]), ...] as a JPEG, off the event loop
+    async def render_tiers(self, grouped):
+        loop = asyncio.get_running_loop()
+        sources = [(f"{type}_{number}", self.db.img_path(number, type)) for _, things in grouped for type, number in things]
+        async with self.atlas_lock:
+            if self.atlas is None:
+                self.atlas = await loop.run_in_executor(None, Atlas, self.atlas_path)
+            await loop.run_in_executor(None, self.atlas.sync, sources)
+            keyed = [(name, [f"{t}_{n}" for t, n in things]) for name, things in grouped]
+            return await loop.run_in_executor(None, render, self.atlas, keyed)
+
+    @commands.slash_command(description = "Show how the current round is going, without ending it.")
+    @commands.has_any_role("Whopper")
+    async def peek(self, ctx: discord.ApplicationContext):
+        msgs = await self.db.get_messages(ctx.channel_id)
+        if not msgs:
+            await ctx.respond("A round is not in progress.", ephemeral=True)
+            return
+
+        type = await self.db.get_round_type(ctx.channel_id)
+        lines = []
+        for message_id, number in msgs:
+            scores = self.tally.histogram(message_id)
+            txt = self.db.catalogue.label(type, number)
+            if scores is None:
+                lines.append(f"{txt}: not counted yet")
+                continue
+            removed, total, avg = weighted_average(scores.copy())
+            lines.append(f"{txt}: {avg:.4f} from {self.tally.voters(message_id)} voters")
+        await ctx.respond("\n".join(lines), ephemeral=True)
 
     @commands.slash_command()
     @commands.has_any_role("Whopper")
     async def stop(self, ctx: discord.ApplicationContext):
-        self.mutex.acquire()
+        try:
+            async with self.exclusive(ctx, ctx.channel_id):
+                with metrics.span("command", command="stop"):
+                    await self.stop_round(ctx)
+        except Busy:
+            metrics.inc("busy", command="stop")
+            await ctx.respond(busy_message)
+
+    async def stop_round(self, ctx: discord.ApplicationContext):
         # If there are messages, we are in progress
-        if self.db.get_messages(ctx.channel_id):
-            self.in_progress = True
+        if await self.db.get_messages(ctx.channel_id):
+            self.rounds.in_progress.add(ctx.channel_id)
 
-        if not self.in_progress:
+        if ctx.channel_id not in self.rounds.in_progress:
             await ctx.respond("A round is not in progress.")
-            self.mutex.release()
             return
 
         await ctx.respond("Ok! Tallying votes :)")
-
-        # Lock threads from the previous round
-        for item in self.db.get_forum_posts():
-            thread = await self.bot.fetch_channel(item[0])
-            if thread is None:
-                self.db.remove_forum_post(item[0])
-                continue
-            await thread.edit(locked=True)
+        phases = metrics.Phases("stop")
 
         ch = self.bot.get_channel(ctx.channel_id)
-        msgs = self.db.get_messages(ctx.channel_id)
+        msgs = await self.db.get_messages(ctx.channel_id)
 
-        type = self.db.get_round_type()
+        type = await self.db.get_round_type(ctx.channel_id)
+        results = []
         summaries = []
+        to_delete = []
         for item in msgs:
-            msg = await ch.fetch_message(item[0])
-            if msg is None:
-                self.db.remove_message(item[0])
-            
-            max_vote = 10
-            if type != "card":
-                max_vote = 5
-
-            scores = [0]*max_vote
-            for r in msg.reactions:
-                score = score_from_reaction_name(r.emoji)
-                if score is None:
+            scores = self.tally.histogram(item[0])
+            if scores is None:
+                # Not something we've been counting (e.g. it was deleted), so ask Discord
+                try:
+                    msg = await ch.fetch_message(item[0])
+                except discord.NotFound:
+                    # Someone deleted it, there's nothing to count
+                    results.append((item[0], item[1], None))
                     continue
-                # Be sure to remove our own reaction
-                scores[score-1] = r.count - 1
-            
-            # Insert the votes for the thing
-            # and mark it as having been voted on so it isn't picked again
-            txt = ""
-            if type == "card":
-                self.db.add_scores(item[1], scores)
-                self.db.mark_has_voted(item[1])
-                txt = f"No. {item[1]} {self.db.get_name(item[1])}"
-            elif type == "map":
-                self.db.add_map_scores(item[1], scores)
-                self.db.mark_map_has_voted(item[1])
-                txt = self.db.get_map_name(item[1])
-            else:
-                self.db.add_sleeve_scores(item[1], scores)
-                self.db.mark_sleeve_has_voted(item[1])
-                txt = self.db.get_sleeve_name(item[1])
+                scores = scores_from_message(msg, max_vote_for(type))
+
+            results.append((item[0], item[1], scores))
+            to_delete.append(item[0])
+
+            txt = self.db.catalogue.label(type, item[1])
 
             removed, total, avg = weighted_average(scores.copy())
 
@@ -281,67 +868,41 @@ class Poller(commands.Cog):
             )
 
             summaries.append((ctx.channel_id, summary.id))
+        phases.mark("count")
 
-            # Clean up our message
-            if self.should_delete_messages:
-                await msg.delete()
-
-            # Remove that message from the table
-            self.db.remove_message(item[0])
-
+        # Nothing is written until the end, so count as if this round's things are already done
+        numbers = [r[1] for r in results if r[2] is not None]
+        cost, left = await self.db.left_after(ctx.guild_id, type, numbers)
         if type == "card":
-            cost = self.db.get_lowest_cost()
-            left = self.db.number_for_cost(cost)
             summary = await ctx.send(f"There are {left} cards with cost {cost} remaining.")
-            summaries.append((ctx.channel_id, summary.id))
-        elif type == "map":
-            summary = await ctx.send(f"There are {self.db.maps_left()} maps remaining.")
-            summaries.append((ctx.channel_id, summary.id))
         else:
-            summary = await ctx.send(f"There are {self.db.sleeves_left()} sleeves remaining.")
-            summaries.append((ctx.channel_id, summary.id))
-
-        self.db.insert_summaries(summaries)
-        self.in_progress = False
-        self.mutex.release()
-
-# We want to round half upwards, so here is a helper
-def normal_round(n):
-    if n - floor(n) < 0.5:
-        return floor(n)
-    return ceil(n)
-
-# Computes the weighted average of the list after removing
-# the top and bottom 10% of votes.
-def weighted_average(lst):
-    total_votes = sum(lst)
-    if total_votes == 0:
-        return (0, 0, 0)
-    
-    to_remove = normal_round((total_votes/10)+0.01)
-
-    def remove(idxs):
-        removed = 0
-        for i in idxs:
-            if lst[i] > 0:
-                # If we can remove all needed votes from this slot do so
-                if lst[i] > (to_remove - removed):
-                    lst[i] -= (to_remove - removed)
-                    removed = to_remove
-                    break
-                # otherwise, remove what we can
-                else:
-                    removed += lst[i]
-                    lst[i] = 0
-
-    remove(range(len(lst)))
-    remove(range(len(lst))[::-1])
-    
-    s = 0
-    for i in range(len(lst)):
-        s += (i+1)*lst[i]
-    
-    return (to_remove, s, s/(total_votes - (to_remove * 2)))
-
-def setup(bot: discord.Bot, db: DB, should_delete_messages: bool = False):
-    bot.add_cog(Poller(bot, db, should_delete_messages))
\ No newline at end of file
+            summary = await ctx.send(f"There are {left} {type}s remaining.")
+        summaries.append((ctx.channel_id, summary.id))
+        phases.mark("summaries")
+
+        # Insert the votes for each thing, mark them as having been voted on so they
+        # aren't picked again, and forget about our messages - all or nothing.
+        taken, ballots = self.tally.take_dirty({item[0] for item in msgs})
+        try:
+            await self.db.finish_round(ctx.guild_id, ctx.channel_id, type, results, summaries, ballots)
+        except Exception:
+            self.tally.mark_dirty(taken)
+            raise
+        self.rounds.in_progress.discard(ctx.channel_id)
+        for item in msgs:
+            self.tally.forget(item[0])
+        for _, number, scores in results:
+            if scores is not None:
+                self.tiers.record(ctx.guild_id, type, number, scores)
+        phases.mark("finish")
+
+        # Lock this round's threads and clean up our messages, in the background
+        threads = await self.db.take_forum_posts(ctx.channel_id)
+        self.cleanup.lock_threads(self.get_thread, threads, self.db.remove_forum_posts)
+        if self.should_delete_messages:
+            self.cleanup.delete_messages(ch, to_delete)
+        phases.mark("cleanup")
+
+def setup(bot: discord.Bot, db: AsyncDB, should_delete_messages: bool = False, queue_busy_commands: bool = False, atlas_path: str = ".atlas", assets: AssetCache = None, diff_path: str = "manifest_diff.json",
+          metrics_port: int = None, metrics_json_path: str = None, export_path: str = "exports"):
+    bot.add_cog(Poller(bot, db, should_delete_messages, queue_busy_commands, atlas_path, assets or AssetCache(), diff_path, metrics_port, metrics_json_path, export_path))
\ No newline at end of file
@@ -0,0 +1,67 @@
+import re
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+# Card names show up typed all sorts of ways, so lookups by name go through this
+def normalize(name: str) -> str:
+    name = name.replace("\N{right single quotation mark}", "'").replace("\N{left single quotation mark}", "'")
+    return re.sub(r"\s+", " ", name).strip().casefold()
+
+# Field order matches the rows the DB used to hand back, so thing[0] is
+# still the number and thing[1] the name.
+class Entity(NamedTuple):
+    number: int
+    name: str
+    rarity: Optional[str]
+    cost: Optional[int]
+    type: str
+
+# Everything we know about every card, map and sleeve, built once from the
+# manifests and never changed afterwards - build a new one instead. That makes
+# it safe to share between the DB threads and the bot.
+#
+# `retired` is the same shape as `manifests`, for things since removed from
+# them but kept around because they were voted on. Those can still be looked
+# up by number, so their scores have names, but aren't part of all() or found
+# by name.
+class Catalogue:
+    def __init__(self, manifests: dict, retired: dict = None):
+        by_number = {}
+        by_name = {}
+        current = {}
+        for typ, manifest in manifests.items():
+            numbers = {}
+            names = {}
+            for number, meta in manifest.items():
+                entity = Entity(int(number), meta["name"], meta.get("rarity"), meta.get("cost"), typ)
+                numbers[entity.number] = entity
+                names.setdefault(normalize(entity.name), entity)
+            current[typ] = MappingProxyType(numbers)
+            numbers = dict(numbers)
+            for number, meta in (retired or {}).get(typ, {}).items():
+                numbers.setdefault(int(number), Entity(int(number), meta["name"], meta.get("rarity"), meta.get("cost"), typ))
+            by_number[typ] = MappingProxyType(numbers)
+            by_name[typ] = MappingProxyType(names)
+        self.current = MappingProxyType(current)
+        self.by_number = MappingProxyType(by_number)
+        self.by_name = MappingProxyType(by_name)
+
+    def get(self, typ: str, number: int) -> Optional[Entity]:
+        return self.by_number[typ].get(int(number))
+
+    # Whether it's still in the manifests, and so can still come up in rounds
+    def is_current(self, typ: str, number: int) -> bool:
+        return int(number) in self.current[typ]
+
+    def find(self, typ: str, name: str) -> Optional[Entity]:
+        return self.by_name[typ].get(normalize(name))
+
+    def all(self, typ: str):
+        return self.current[typ].values()
+
+    # How the bot shows a thing in messages
+    def label(self, typ: str, number: int) -> str:
+        entity = self.get(typ, number)
+        if typ == "card":
+            return f"No. {entity.number} {entity.name}"
+        return entity.name
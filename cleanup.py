@@ -0,0 +1,131 @@
+import asyncio
+import datetime
+
+import discord
+
+import metrics
+
+# Discord only bulk deletes messages younger than this
+BULK_DELETE_AGE = datetime.timedelta(days=14)
+BULK_DELETE_MAX = 100
+
+# Deletes old messages and locks finished threads in the background, so /start
+# and /stop can answer without waiting on any of it.
+#
+# Every job is its own task, and at most `concurrency` requests are in flight
+# at once across all of them. Messages in the same channel go in bulk, up to
+# 100 a request; only lone messages and ones too old to bulk delete go one by one.
+#
+# Each job takes a `done` callback, awaited with the ids that were dealt with
+# (already gone counts), e.g. to drop them from the database. Anything that
+# failed isn't passed on, so it stays recorded and can be tried again later.
+class CleanupWorker:
+    def __init__(self, concurrency: int = 4):
+        self.limit = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        # ids queued or in flight, so asking twice doesn't do it twice
+        self.pending = set()
+
+        # Metrics
+        self.deleted = 0
+        self.locked = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.pending),
+            "deleted": self.deleted,
+            "locked": self.locked,
+            "failed": self.failed,
+        }
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        # The loop only keeps weak references to tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def claim(self, kind: str, ids):
+        ids = [id for id in ids if (kind, id) not in self.pending]
+        self.pending.update((kind, id) for id in ids)
+        return ids
+
+    def delete_messages(self, channel, ids, done=None):
+        ids = self.claim("message", ids)
+        if ids:
+            self.spawn(self.run(self.delete_all(channel, ids), "message", ids, done))
+
+    # get_thread(id) should return the thread, fetching it if need be
+    def lock_threads(self, get_thread, ids, done=None):
+        ids = self.claim("thread", ids)
+        if ids:
+            self.spawn(self.run(self.lock_all(get_thread, ids), "thread", ids, done))
+
+    async def run(self, job, kind: str, ids, done):
+        try:
+            handled = await job
+            if done is not None and handled:
+                await done(handled)
+        finally:
+            self.pending.difference_update((kind, id) for id in ids)
+
+    # Waits for everything queued so far
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    async def delete_all(self, channel, ids):
+        cutoff = discord.utils.utcnow() - BULK_DELETE_AGE
+        recent = [id for id in ids if discord.utils.snowflake_time(id) > cutoff]
+        single = [id for id in ids if discord.utils.snowflake_time(id) <= cutoff]
+        jobs = []
+        for start in range(0, len(recent), BULK_DELETE_MAX):
+            chunk = recent[start:start+BULK_DELETE_MAX]
+            # Bulk deleting wants at least two
+            if len(chunk) == 1:
+                single += chunk
+            else:
+                jobs.append(self.delete_bulk(channel, chunk))
+        jobs += [self.delete_one(channel, id) for id in single]
+        return [id for handled in await asyncio.gather(*jobs) for id in handled]
+
+    async def delete_bulk(self, channel, ids):
+        try:
+            async with self.limit:
+                with metrics.span("cleanup", op="bulk_delete"):
+                    await channel.delete_messages([channel.get_partial_message(id) for id in ids])
+        except discord.HTTPException:
+            # Likely one of them being gone or too old, sort it out one at a time
+            return [id for handled in await asyncio.gather(*[self.delete_one(channel, id) for id in ids]) for id in handled]
+        self.deleted += len(ids)
+        return ids
+
+    async def delete_one(self, channel, id):
+        async with self.limit:
+            try:
+                with metrics.span("cleanup", op="delete"):
+                    await channel.get_partial_message(id).delete()
+                self.deleted += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                self.failed += 1
+                return []
+        return [id]
+
+    async def lock_all(self, get_thread, ids):
+        return [id for handled in await asyncio.gather(*[self.lock_one(get_thread, id) for id in ids]) for id in handled]
+
+    async def lock_one(self, get_thread, id):
+        async with self.limit:
+            try:
+                with metrics.span("cleanup", op="lock_thread"):
+                    thread = await get_thread(id)
+                    await thread.edit(locked=True)
+                self.locked += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                self.failed += 1
+                return []
+        return [id]
@@ -1,7 +1,56 @@
+import asyncio
+import hashlib
 import os
 import re
 import sqlite3
 import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import metrics
+from catalogue import Catalogue
+from migrations import create_views, migrate
+from pool import UnvotedPool
+
+# Pragmas applied to every connection, override any of them by passing
+# storage_profile to DB. WAL means readers - our own read-only connection, or
+# anything else looking at the file - never block the writer, and the writer
+# never blocks them. With WAL, synchronous=NORMAL only fsyncs on checkpoints.
+DEFAULT_STORAGE_PROFILE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    # Bytes of the file to memory map for reads
+    "mmap_size": 64 * 1024 * 1024,
+    # Negative means KiB rather than pages
+    "cache_size": -16 * 1024,
+    # Milliseconds to wait on a lock held by another process before giving up
+    "busy_timeout": 5000,
+}
+
+# Python's sqlite3 keeps compiled statements around, keyed by their SQL text.
+# Every query here has fixed text, so this is plenty to hold all of them.
+CACHED_STATEMENTS = 256
+
+# Bump whenever the tables or indexes below change, so existing databases get
+# them on the next start instead of being assumed up to date. If existing data
+# has to move, add a migration for the new version to migrations.py too.
+SCHEMA_VERSION = 6
+
+TYPES = ["card", "map", "sleeve"]
+
+def fingerprint(path: str) -> str:
+    if not os.path.exists(path):
+        return "missing"
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# What's kept in memory for one guild: its unvoted pools, {type: UnvotedPool},
+# and its settings. Loaded the first time the guild comes up, then kept in step
+# with the tables by the DB methods that change them.
+class GuildState:
+    def __init__(self, pools: dict, settings: dict):
+        self.pools = pools
+        self.settings = settings
 
 class DB:
     def __init__(
@@ -11,67 +60,187 @@ class DB:
             # hehe.
             mapifest_path: str,
             sleeve_manifest_path: str,
-            gallery_path: str
+            gallery_path: str,
+            readonly: bool = False,
+            storage_profile: dict = None,
+            lazy: bool = False,
+            legacy_guild_id: int = None,
     ):
-        self.conn = sqlite3.connect(fname)
         self.gallery_path = gallery_path
-        cur = self.conn.cursor()
-
-        with open(mapifest_path) as f:
-            self.mapifest = json.loads(f.read())
-
-        with open(manifest_path) as f:
-            self.manifest = json.loads(f.read())
-
-        with open(sleeve_manifest_path) as f:
-            self.sleeve_manifest = json.loads(f.read())
+        profile = {**DEFAULT_STORAGE_PROFILE, **(storage_profile or {})}
+        if readonly:
+            # Someone else owns the schema, we just look at it.
+            # The journal mode belongs to the file, so that's up to the writer too.
+            self.conn = sqlite3.connect(f"file:{fname}?mode=ro", uri=True, cached_statements=CACHED_STATEMENTS)
+            profile.pop("journal_mode", None)
+            self.apply_profile(profile)
+            return
+
+        self.conn = sqlite3.connect(fname, cached_statements=CACHED_STATEMENTS)
+        self.apply_profile(profile)
+
+        self.manifest_paths = {
+            "card": manifest_path,
+            "map": mapifest_path,
+            "sleeve": sleeve_manifest_path,
+        }
+        # Filled in the first time they're needed, see the properties below
+        self.manifests_cache = None
+        self.catalogue_cache = None
+        # guild id -> GuildState
+        self.guilds = {}
+
+        # Restarting with the same manifests and the same schema as last time
+        # is the usual case, and then there's nothing to create or ingest
+        fingerprints = {typ: fingerprint(path) for typ, path in self.manifest_paths.items()}
+        if self.stored_meta() != self.wanted_meta(fingerprints):
+            # Older databases are moved over first, which commits as it goes
+            migrate(self.conn, SCHEMA_VERSION)
+            with self.conn:
+                cur = self.conn.cursor()
+                self.create_schema(cur)
+                self.ingest(cur)
+                cur.executemany("INSERT OR REPLACE INTO meta VALUES(?, ?)", self.wanted_meta(fingerprints).items())
+
+        if legacy_guild_id is not None:
+            self.claim_legacy(legacy_guild_id)
+
+        # With lazy set, the manifests are only parsed and each guild's pools
+        # only built when something first asks for them, which gets the bot
+        # online sooner
+        if not lazy:
+            self.catalogue
+            for (guild_id,) in self.conn.execute("SELECT DISTINCT guild_id FROM guild_settings").fetchall():
+                self.guild(guild_id)
+
+    # The manifests as {type: {number: metadata}}. Only the card manifest has to
+    # exist, missing map or sleeve manifests just mean there are none of those.
+    @property
+    def manifests(self) -> dict:
+        if self.manifests_cache is None:
+            manifests = {}
+            for typ, path in self.manifest_paths.items():
+                if typ != "card" and not os.path.exists(path):
+                    manifests[typ] = {}
+                    continue
+                with open(path) as f:
+                    manifests[typ] = json.loads(f.read())
+            self.manifests_cache = manifests
+        return self.manifests_cache
+
+    @property
+    def catalogue(self) -> Catalogue:
+        if self.catalogue_cache is None:
+            self.catalogue_cache = self.build_catalogue()
+        return self.catalogue_cache
+
+    # The manifests, plus anything /sync removed from them which is still in
+    # entities because it was voted on
+    def build_catalogue(self) -> Catalogue:
+        manifests = self.manifests
+        retired = {typ: {} for typ in TYPES}
+        for typ, number, name, cost, rarity in self.conn.execute("SELECT type, number, name, cost, rarity FROM entities"):
+            if str(number) not in manifests.get(typ, {}):
+                retired.setdefault(typ, {})[str(number)] = {"name": name, "cost": cost, "rarity": rarity}
+        return Catalogue(manifests, retired)
+
+    # Picking and counting candidates is served from memory, per guild
+    def guild(self, guild_id) -> GuildState:
+        state = self.guilds.get(guild_id)
+        if state is None:
+            pools = {typ: UnvotedPool() for typ in TYPES}
+            rows = self.conn.execute("""SELECT type, number, cost FROM entities e WHERE NOT EXISTS
+                (SELECT 1 FROM voted v WHERE v.guild_id = ? AND v.type = e.type AND v.number = e.number)
+                AND NOT EXISTS (SELECT 1 FROM reserved r WHERE r.guild_id = ? AND r.type = e.type AND r.number = e.number)""", [guild_id, guild_id])
+            for typ, number, cost in rows:
+                # Things /sync removed stay in entities if anyone voted on
+                # them, but mustn't come up again anywhere
+                if not self.catalogue.is_current(typ, number):
+                    continue
+                # Only cards are picked by cost
+                pools[typ].add(number, cost if typ == "card" else None)
+            settings = dict(self.conn.execute("SELECT key, value FROM guild_settings WHERE guild_id = ?", [guild_id]).fetchall())
+            state = self.guilds[guild_id] = GuildState(pools, settings)
+        return state
+
+    def pools(self, guild_id) -> dict:
+        return self.guild(guild_id).pools
+
+    # Hands everything from before guilds were kept track of (filed under
+    # guild 0 by the migration) to the guild it belongs to. Nothing to do
+    # after the first time.
+    def claim_legacy(self, guild_id):
+        with self.conn:
+            cur = self.conn.cursor()
+            for table in ["histograms", "voted", "guild_settings", "rounds", "reserved"]:
+                cur.execute(f"UPDATE OR IGNORE {table} SET guild_id = ? WHERE guild_id = 0", [guild_id])
+        self.guilds.pop(guild_id, None)
+
+    def wanted_meta(self, fingerprints: dict) -> dict:
+        meta = {"schema_version": str(SCHEMA_VERSION)}
+        for typ, digest in fingerprints.items():
+            meta["manifest:" + typ] = digest
+        return meta
+
+    # What the database says it was last brought up to date with, {} if it never has been
+    def stored_meta(self) -> dict:
+        try:
+            return dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+        except sqlite3.OperationalError:
+            return {}
+
+    def create_schema(self, cur):
+        cur.execute("""CREATE TABLE IF NOT EXISTS meta(
+            key VARCHAR(255) PRIMARY KEY,
+            value VARCHAR(255)
+        )""")
 
-        # "Why not have one table - say, 'entities' - with a 'type' column"?
-        #
-        # Don't think about it, hacky is the spirit of the exercise.
-        cur.execute("""CREATE TABLE IF NOT EXISTS cards(
-            number INTEGER PRIMARY KEY,
+        # Everything of every type, keyed by type. Shared by every guild.
+        cur.execute("""CREATE TABLE IF NOT EXISTS entities(
+            type VARCHAR(255),
+            number INTEGER,
             name VARCHAR(255),
             cost INTEGER,
             rarity VARCHAR(255),
-            voted INTEGER
+            PRIMARY KEY (type, number)
         )""")
 
-        cur.execute("""CREATE TABLE IF NOT EXISTS maps(
-            number INTEGER PRIMARY KEY,
-            name VARCHAR(255),
-            voted INTEGER
-        )""")
-
-        cur.execute("""CREATE TABLE IF NOT EXISTS sleeves(
-            number INTEGER PRIMARY KEY,
-            name VARCHAR(255),
-            voted INTEGER
-        )""")
-
-        cur.execute("""CREATE TABLE IF NOT EXISTS sleeve_votes(
+        # How many votes each score got, for everything voted on, per guild.
+        # Keyed by guild first, so each guild's rows sit together.
+        cur.execute("""CREATE TABLE IF NOT EXISTS histograms(
+            guild_id INTEGER,
+            type VARCHAR(255),
             number INTEGER,
             score INTEGER,
             votes INTEGER,
-            PRIMARY KEY (number, score)
-        )""")
+            PRIMARY KEY (guild_id, type, number, score)
+        ) WITHOUT ROWID""")
 
-        cur.execute("""CREATE TABLE IF NOT EXISTS map_votes(
+        # What each guild has finished voting on, so it isn't picked again there
+        cur.execute("""CREATE TABLE IF NOT EXISTS voted(
+            guild_id INTEGER,
+            type VARCHAR(255),
             number INTEGER,
-            score INTEGER,
-            votes INTEGER,
-            PRIMARY KEY (number, score)
+            PRIMARY KEY (guild_id, type, number)
+        ) WITHOUT ROWID""")
+
+        # Bot-wide settings
+        cur.execute("""CREATE TABLE IF NOT EXISTS settings(
+            key VARCHAR(255) PRIMARY KEY,
+            value
         )""")
-    
-        cur.execute("""CREATE TABLE IF NOT EXISTS votes(
-            number INTEGER,
-            score INTEGER,
-            votes INTEGER,
-            PRIMARY KEY (number, score)
+
+        # Per guild settings, e.g. forum_chan
+        cur.execute("""CREATE TABLE IF NOT EXISTS guild_settings(
+            guild_id INTEGER,
+            key VARCHAR(255),
+            value,
+            PRIMARY KEY (guild_id, key)
         )""")
 
         # hack: "map", "card", "sleeve"; default card
-        cur.execute("""CREATE TABLE IF NOT EXISTS round_type(
+        cur.execute("""CREATE TABLE IF NOT EXISTS channel_round_type(
+            channel_id INTEGER PRIMARY KEY,
             thing VARCHAR(255)
         )""")
 
@@ -82,195 +251,455 @@ class DB:
             number INTEGER
         )""")
 
+        # Every user's vote on every message, one per user per message.
+        # Kept after the round ends, so there's a record of who voted for what.
+        cur.execute("""CREATE TABLE IF NOT EXISTS ballots(
+            message_id INTEGER,
+            user_id INTEGER,
+            type VARCHAR(255),
+            number INTEGER,
+            score INTEGER,
+            PRIMARY KEY (message_id, user_id)
+        )""")
+
         cur.execute("""CREATE TABLE IF NOT EXISTS summaries(
             channel_id INTEGER,
             id INTEGER
         )""")
 
+        # Forum threads which still need locking. state is "open" while the
+        # round is, then "locking" once /stop has handed it to the cleanup
+        # worker; the row goes once the thread is locked (or gone).
+        # channel_id is the voting channel, NULL for threads from before it was kept.
         cur.execute("""CREATE TABLE IF NOT EXISTS forum_posts(
-            id INTEGER
+            id INTEGER,
+            channel_id INTEGER,
+            state VARCHAR(255) DEFAULT 'open'
         )""")
 
-        cur.execute("""CREATE TABLE IF NOT EXISTS forum_chan(
-            channel_id INTEGER
+        # The round journal: rounds still being started, and each step of
+        # starting them as it's done. A round only leaves here once its
+        # messages and forum posts are in the tables above, so anything a
+        # crash cut short can be finished (or cleaned up) on the next start.
+        cur.execute("""CREATE TABLE IF NOT EXISTS rounds(
+            id INTEGER PRIMARY KEY,
+            channel_id INTEGER,
+            type VARCHAR(255),
+            guild_id INTEGER DEFAULT 0
         )""")
 
-        rows = []
-        for number in self.manifest:
-            rows.append((number, self.manifest[number]["name"], self.manifest[number]["cost"], self.manifest[number]["rarity"]))
+        # step is "planned" (written with the round, in pick order), then
+        # "message_sent", "reactions_seeded", "thread_created", "file_attached".
+        # ref_id is the message or thread the step made.
+        cur.execute("""CREATE TABLE IF NOT EXISTS round_steps(
+            round_id INTEGER,
+            number INTEGER,
+            step VARCHAR(255),
+            ref_id INTEGER,
+            PRIMARY KEY (round_id, number, step)
+        )""")
 
-        cur.executemany("INSERT OR IGNORE INTO cards VALUES(?, ?, ?, ?, 0)", rows)
-        
-        rows = []
-        for number in self.mapifest:
-            rows.append((number, self.mapifest[number]["name"]))
+        # Things picked for a round which hasn't finished yet, so no other
+        # channel in the guild picks them too. Written along with the round's
+        # journal entry, and gone once the round finishes or is dropped.
+        cur.execute("""CREATE TABLE IF NOT EXISTS reserved(
+            guild_id INTEGER,
+            type VARCHAR(255),
+            number INTEGER,
+            channel_id INTEGER,
+            PRIMARY KEY (guild_id, type, number)
+        ) WITHOUT ROWID""")
 
-        cur.executemany("INSERT OR IGNORE INTO maps VALUES(?, ?, 0)", rows)
+        # The old per-type tables, for anything still reading those
+        create_views(self.conn)
 
+    # Adds anything new in the manifests, and brings anything already present
+    # up to date with them. The pools are bucketed by the cost in entities and
+    # everything else goes by the manifests, so the two have to agree even
+    # when a manifest was edited by hand rather than through /sync.
+    def ingest(self, cur):
         rows = []
-        for number in self.sleeve_manifest:
-            rows.append((number, self.sleeve_manifest[number]["name"]))
+        for typ in TYPES:
+            for number, meta in self.manifests[typ].items():
+                rows.append((typ, int(number), meta["name"], meta.get("cost"), meta.get("rarity")))
 
-        cur.executemany("INSERT OR IGNORE INTO sleeves VALUES(?, ?, 0)", rows)
-
-        self.conn.commit()
+        cur.executemany("""INSERT INTO entities VALUES(?, ?, ?, ?, ?) ON CONFLICT(type, number)
+            DO UPDATE SET name = excluded.name, cost = excluded.cost, rarity = excluded.rarity""", rows)
 
-    def get_round_type(self):
+    def apply_profile(self, profile: dict):
         cur = self.conn.cursor()
-        res = cur.execute("SELECT thing FROM round_type").fetchone()
-        return "card" if not res else res[0]
+        for pragma, value in profile.items():
+            cur.execute(f"PRAGMA {pragma} = {value}")
 
-    def set_round_type(self, typ :str):
-        cur = self.conn.cursor()
-        cur.execute("DELETE FROM round_type")
-        cur.execute("INSERT INTO round_type VALUES(?)", [(typ)])
-        self.conn.commit()
+    def get_setting(self, key: str, default=None):
+        res = self.conn.execute("SELECT value FROM settings WHERE key = ?", [key]).fetchone()
+        return default if res is None else res[0]
 
-    def set_forum_chan(self, id):
-        cur = self.conn.cursor()
-        # Drop whatever is in it
-        cur.execute("DELETE FROM forum_chan")
-        cur.execute("INSERT INTO forum_chan VALUES(?)", [(id)])
+    def set_setting(self, key: str, value):
+        self.conn.execute("INSERT OR REPLACE INTO settings VALUES(?, ?)", [key, value])
         self.conn.commit()
 
-    def get_forum_chan(self):
+    def get_round_type(self, channel_id):
         cur = self.conn.cursor()
-        res = cur.execute("SELECT channel_id FROM forum_chan").fetchone()
-        return res if not res else res[0]
+        res = cur.execute("SELECT thing FROM channel_round_type WHERE channel_id = ?", [(channel_id)]).fetchone()
+        if not res:
+            # Rounds started before round types were per channel
+            return self.get_setting("round_type", "card")
+        return res[0]
 
-    def get_card_group(self, round_size):
+    def set_round_type(self, channel_id, typ :str):
         cur = self.conn.cursor()
-        cost = self.get_lowest_cost()
-        res = cur.execute("SELECT number, name, rarity FROM cards WHERE voted = 0 AND cost = ? ORDER BY RANDOM() LIMIT ?;", [(cost), (round_size)])
-        return res.fetchall()
+        cur.execute("INSERT OR REPLACE INTO channel_round_type VALUES(?, ?)", [(channel_id), (typ)])
+        self.conn.commit()
 
-    def get_map_group(self, round_size):
-        cur = self.conn.cursor()
-        res = cur.execute("SELECT number, name FROM maps WHERE voted = 0 ORDER BY RANDOM() LIMIT ?;", [(round_size)])
-        return res.fetchall()
+    # Served from the guild's cached settings
+    def get_guild_setting(self, guild_id, key: str, default=None):
+        return self.guild(guild_id).settings.get(key, default)
 
-    def get_sleeve_group(self, round_size):
-        cur = self.conn.cursor()
-        res = cur.execute("SELECT number, name FROM sleeves WHERE voted = 0 ORDER BY RANDOM() LIMIT ?;", [(round_size)])
-        return res.fetchall()
+    def set_guild_setting(self, guild_id, key: str, value):
+        self.conn.execute("INSERT OR REPLACE INTO guild_settings VALUES(?, ?, ?)", [guild_id, key, value])
+        self.conn.commit()
+        self.guild(guild_id).settings[key] = value
 
-    def get_name(self, num: int):
-        cur = self.conn.cursor()
-        return cur.execute("SELECT name FROM cards WHERE number=?", [(num)]).fetchone()[0]
+    def set_forum_chan(self, guild_id, id):
+        self.set_guild_setting(guild_id, "forum_chan", id)
 
-    def get_map_name(self, num: int):
-        cur = self.conn.cursor()
-        return cur.execute("SELECT name FROM maps WHERE number=?", [(num)]).fetchone()[0]
+    def get_forum_chan(self, guild_id):
+        return self.get_guild_setting(guild_id, "forum_chan")
 
-    def get_sleeve_name(self, num: int):
-        cur = self.conn.cursor()
-        return cur.execute("SELECT name FROM sleeves WHERE number=?", [(num)]).fetchone()[0]
+    # Up to round_size things the guild hasn't voted on yet. Cards come from
+    # the cheapest cost with any left, so rounds work up through the costs.
+    def get_group(self, guild_id, typ: str, round_size):
+        key = self.get_lowest_cost(guild_id) if typ == "card" else None
+        picked = self.pools(guild_id)[typ].sample(round_size, key)
+        return [self.catalogue.get(typ, n) for n in picked]
 
-    def get_img(self, num: int, typ: str):
+    def img_path(self, num: int, typ: str):
         path = str(num)+".jpg"
         if typ != "card":
             path = typ + "_" + str(num) + ".png"
-        return open(os.path.join(self.gallery_path, path), mode="rb")
-    
-    def insert_summaries(self, msgs):
-        cur = self.conn.cursor()
-        cur.executemany("INSERT OR IGNORE INTO summaries VALUES(?, ?)", msgs)
-        self.conn.commit()
+        return os.path.join(self.gallery_path, path)
 
     def get_summaries(self, channel_id):
         cur = self.conn.cursor()
         res = cur.execute("SELECT id FROM summaries WHERE channel_id = ?", [(channel_id)]).fetchall()
         return res
 
-    def remove_summary(self, msg_id):
+    def remove_summaries(self, msg_ids):
         cur = self.conn.cursor()
-        cur.execute("DELETE FROM summaries WHERE id = ?", [(msg_id)])
+        cur.executemany("DELETE FROM summaries WHERE id = ?", [(id,) for id in msg_ids])
         self.conn.commit()
 
-    def insert_messages(self, msgs):
+    # Thread ids in a state, across every channel
+    def get_forum_posts(self, state: str):
         cur = self.conn.cursor()
-        cur.executemany("INSERT OR IGNORE INTO messages VALUES(?, ?, ?)", msgs)
-        self.conn.commit()
-
-    def insert_forum_posts(self, msgs):
+        return [row[0] for row in cur.execute("SELECT id FROM forum_posts WHERE state = ?", [state])]
+
+    # Moves a channel's open threads on to "locking", returning their ids
+    def take_forum_posts(self, channel_id):
+        with self.conn:
+            cur = self.conn.cursor()
+            ids = [row[0] for row in cur.execute(
+                "SELECT id FROM forum_posts WHERE state = 'open' AND (channel_id = ? OR channel_id IS NULL)", [channel_id])]
+            cur.executemany("UPDATE forum_posts SET state = 'locking' WHERE id = ?", [(id,) for id in ids])
+        return ids
+
+    def remove_forum_posts(self, ids):
         cur = self.conn.cursor()
-        cur.executemany("INSERT OR IGNORE INTO forum_posts VALUES(?)", msgs)
+        cur.executemany("DELETE FROM forum_posts WHERE id = ?", [(id,) for id in ids])
         self.conn.commit()
 
-    def get_forum_posts(self):
-        cur = self.conn.cursor()
-        res = cur.execute("SELECT id FROM forum_posts").fetchall()
-        return res
+    # Picks up to round_size things and writes the round and what it's going
+    # to post to the journal, before any of it is posted. What's picked is
+    # reserved in the same go, so a round starting in another channel can't
+    # pick it too. Returns the round's id and the things.
+    def begin_round(self, guild_id, channel_id, typ: str, round_size):
+        things = self.get_group(guild_id, typ, round_size)
+        numbers = [thing[0] for thing in things]
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.execute("INSERT INTO rounds(channel_id, type, guild_id) VALUES(?, ?, ?)", [channel_id, typ, guild_id])
+            round_id = cur.lastrowid
+            cur.executemany("INSERT OR IGNORE INTO round_steps VALUES(?, ?, 'planned', NULL)", [(round_id, n) for n in numbers])
+            cur.executemany("INSERT OR REPLACE INTO reserved VALUES(?, ?, ?, ?)", [(guild_id, typ, n, channel_id) for n in numbers])
+        pool = self.pools(guild_id)[typ]
+        for n in numbers:
+            pool.remove(n)
+        return round_id, things
+
+    # Lets go of everything a channel's round reserved, returning [(type, number), ...]
+    def release(self, cur, guild_id, channel_id):
+        rows = cur.execute("SELECT type, number FROM reserved WHERE guild_id = ? AND channel_id = ?", [guild_id, channel_id]).fetchall()
+        cur.execute("DELETE FROM reserved WHERE guild_id = ? AND channel_id = ?", [guild_id, channel_id])
+        return rows
+
+    # Puts released things back up for picking, unless they've been voted on
+    # since or /sync has removed them
+    def unreserve(self, guild_id, rows, voted=()):
+        pools = self.pools(guild_id)
+        for typ, number in rows:
+            if not self.catalogue.is_current(typ, number) or (typ, number) in voted:
+                continue
+            pools[typ].add(number, self.catalogue.get(typ, number).cost if typ == "card" else None)
+
+    # Replaces any earlier record of the same step, e.g. a message re-sent
+    # because the first one was deleted
+    def journal_step(self, round_id, number, step: str, ref_id=None):
+        self.conn.execute("INSERT OR REPLACE INTO round_steps VALUES(?, ?, ?, ?)", [round_id, number, step, ref_id])
+        self.conn.commit()
 
-    def remove_forum_post(self, id):
+    # [(round id, guild id, channel id, type, [planned numbers], {(number, step): ref id}), ...]
+    def get_journal(self):
         cur = self.conn.cursor()
-        cur.execute("DELETE FROM forum_posts WHERE id = ?", [(id)])
-        self.conn.commit()
+        out = []
+        for round_id, guild_id, channel_id, typ in cur.execute("SELECT id, guild_id, channel_id, type FROM rounds ORDER BY id").fetchall():
+            numbers = []
+            done = {}
+            for number, step, ref_id in cur.execute("SELECT number, step, ref_id FROM round_steps WHERE round_id = ? ORDER BY rowid", [round_id]):
+                if step == "planned":
+                    numbers.append(number)
+                else:
+                    done[(number, step)] = ref_id
+            out.append((round_id, guild_id, channel_id, typ, numbers, done))
+        return out
+
+    # Hands a fully posted round over from the journal to the in-flight tables
+    def commit_round(self, round_id, channel_id, typ: str, msgs, forum_posts):
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.executemany("INSERT OR IGNORE INTO messages VALUES(?, ?, ?)", msgs)
+            cur.executemany("INSERT OR IGNORE INTO forum_posts VALUES(?, ?, 'open')", [(id, channel_id) for id in forum_posts])
+            cur.execute("INSERT OR REPLACE INTO channel_round_type VALUES(?, ?)", [channel_id, typ])
+            self.clear_journal(cur, round_id)
+
+    # Gives up on a round in the journal, and on what it reserved
+    def drop_round(self, round_id):
+        with self.conn:
+            cur = self.conn.cursor()
+            row = cur.execute("SELECT guild_id, channel_id FROM rounds WHERE id = ?", [round_id]).fetchone()
+            released = self.release(cur, *row) if row else []
+            self.clear_journal(cur, round_id)
+        if row:
+            self.unreserve(row[0], released)
+
+    def clear_journal(self, cur, round_id):
+        cur.execute("DELETE FROM round_steps WHERE round_id = ?", [round_id])
+        cur.execute("DELETE FROM rounds WHERE id = ?", [round_id])
 
     def get_messages(self, channel_id):
         cur = self.conn.cursor()
         res = cur.execute("SELECT id, number FROM messages WHERE channel_id = ?", [(channel_id)]).fetchall()
         return res
     
-    def add_scores(self, number, scores):
-        cur = self.conn.cursor()
-        rows = [(number, x+1, scores[x]) for x in range(len(scores))]
-        res = cur.executemany("INSERT OR REPLACE INTO votes VALUES(?, ?, ?)", rows)
-        self.conn.commit()
-
-    def add_map_scores(self, number, scores):
-        cur = self.conn.cursor()
-        rows = [(number, x+1, scores[x]) for x in range(len(scores))]
-        res = cur.executemany("INSERT OR REPLACE INTO map_votes VALUES(?, ?, ?)", rows)
-        self.conn.commit()
-
-    def add_sleeve_scores(self, number, scores):
+    def get_all_messages(self):
         cur = self.conn.cursor()
-        rows = [(number, x+1, scores[x]) for x in range(len(scores))]
-        res = cur.executemany("INSERT OR REPLACE INTO sleeve_votes VALUES(?, ?, ?)", rows)
-        self.conn.commit()
-
-    def mark_has_voted(self, number):
-        cur = self.conn.cursor()
-        cur.execute("UPDATE cards SET voted = 1 WHERE number=?", [(number)])
-        self.conn.commit()
-
-    def mark_map_has_voted(self, number):
-        cur = self.conn.cursor()
-        cur.execute("UPDATE maps SET voted = 1 WHERE number=?", [(number)])
-        self.conn.commit()
-
-    def mark_sleeve_has_voted(self, number):
-        cur = self.conn.cursor()
-        cur.execute("UPDATE sleeves SET voted = 1 WHERE number=?", [(number)])
-        self.conn.commit()
-
-    def number_for_name(self, name):
-        cur = self.conn.cursor()
-        res = cur.execute("SELECT number FROM cards WHERE name=?", [(name)]).fetchone()[0]
+        res = cur.execute("SELECT channel_id, id, number FROM messages").fetchall()
         return res
 
-    def remove_message(self, msg_id):
-        cur = self.conn.cursor()
-        cur.execute("DELETE FROM messages WHERE id = ?", [(msg_id)])
-        self.conn.commit()
+    # rows are (message id, user id, type, number, score), where a score of
+    # None means that user no longer has a vote on that message
+    def save_ballots(self, rows):
+        with self.conn:
+            self.write_ballots(self.conn.cursor(), rows)
 
-    def get_lowest_cost(self):
-        cur = self.conn.cursor()
-        res = cur.execute("SELECT MIN(cost) FROM cards WHERE voted = 0").fetchone()
-        return 99 if not res else res[0]
-    
-    def number_for_cost(self, cost):
-        cur = self.conn.cursor()
-        res = cur.execute("SELECT COUNT(*) FROM cards WHERE cost = ? AND voted = 0", [(cost)]).fetchone()
-        return res[0]
+    def write_ballots(self, cur, rows):
+        cur.executemany("INSERT OR REPLACE INTO ballots VALUES(?, ?, ?, ?, ?)", [r for r in rows if r[4] is not None])
+        cur.executemany("DELETE FROM ballots WHERE message_id = ? AND user_id = ?", [r[:2] for r in rows if r[4] is None])
 
-    def maps_left(self):
+    # message id -> {user id: score}, for in-flight messages only
+    def get_ballots(self):
         cur = self.conn.cursor()
-        res = cur.execute("SELECT COUNT(*) FROM maps WHERE voted = 0").fetchone()
-        return res[0]
+        out = {}
+        for message_id, user_id, score in cur.execute("SELECT message_id, user_id, score FROM ballots WHERE message_id IN (SELECT id FROM messages)"):
+            out.setdefault(message_id, {})[user_id] = score
+        return out
 
-    def sleeves_left(self):
+    # number -> [votes for 1, votes for 2, ...] for everything of a type with votes
+    def get_histograms(self, guild_id, typ):
         cur = self.conn.cursor()
-        res = cur.execute("SELECT COUNT(*) FROM sleeves WHERE voted = 0").fetchone()
-        return res[0]
\ No newline at end of file
+        out = {}
+        for number, score, votes in cur.execute("SELECT number, score, votes FROM histograms WHERE guild_id = ? AND type = ? ORDER BY number, score", [guild_id, typ]):
+            out.setdefault(number, []).append(votes)
+        return out
+
+    def get_lowest_cost(self, guild_id):
+        cost = self.pools(guild_id)["card"].lowest_key()
+        return 99 if cost is None else cost
+
+    # How many things would be left if `numbers` were marked as voted, as
+    # (lowest cost, how many of that cost) for cards - (99, 0) if none - and
+    # (None, how many) for everything else
+    def left_after(self, guild_id, typ: str, numbers):
+        pools = self.pools(guild_id)
+        if typ != "card":
+            return None, pools[typ].count_after(numbers)
+        cost, left = pools["card"].lowest_after(numbers)
+        return (99, 0) if cost is None else (cost, left)
+
+    # Records everything about a finished round in a single transaction: the votes,
+    # the voted flags, removing the in-flight messages and adding the summaries.
+    # A crash part way through leaves the round exactly as it was before.
+    # Whatever the round reserved and didn't get votes for goes back to be picked again.
+    #
+    # results is a list of (message id, number, scores); scores is None for
+    # messages which went missing and should just be forgotten.
+    #
+    # ballots are any not-yet-saved rows for save_ballots, so the ballots on
+    # record always agree with the scores.
+    def finish_round(self, guild_id, channel_id, typ, results, summaries, ballots=()):
+        with self.conn:
+            cur = self.conn.cursor()
+            self.write_ballots(cur, ballots)
+            for msg_id, number, scores in results:
+                if scores is not None:
+                    rows = [(guild_id, typ, number, x+1, scores[x]) for x in range(len(scores))]
+                    cur.executemany("INSERT OR REPLACE INTO histograms VALUES(?, ?, ?, ?, ?)", rows)
+                    cur.execute("INSERT OR IGNORE INTO voted VALUES(?, ?, ?)", [guild_id, typ, number])
+                cur.execute("DELETE FROM messages WHERE id = ?", [(msg_id)])
+            cur.executemany("INSERT OR IGNORE INTO summaries VALUES(?, ?)", summaries)
+            released = self.release(cur, guild_id, channel_id)
+
+        voted = {(typ, number) for msg_id, number, scores in results if scores is not None}
+        pools = self.pools(guild_id)
+        for _, number in voted:
+            pools[typ].remove(number)
+        self.unreserve(guild_id, released, voted)
+
+    # Applies a diff written by sync.py to the running bot: the tables, the
+    # catalogue and the unvoted pools all change together, no restart needed.
+    # Applying the same diff twice is harmless.
+    #
+    # Removed things which have already been voted on in any guild stay put,
+    # so their scores still have names attached; they just can't come up again.
+    # Every guild's cached pools are updated.
+    def apply_manifest_diff(self, diff: dict):
+        manifests = self.manifests
+        changed = {}
+        with self.conn:
+            cur = self.conn.cursor()
+            for typ in TYPES:
+                changes = diff.get(typ)
+                if not changes:
+                    continue
+                upsert = changes.get("upsert", {})
+                cur.executemany("""INSERT INTO entities VALUES(?, ?, ?, ?, ?) ON CONFLICT(type, number)
+                    DO UPDATE SET name = excluded.name, cost = excluded.cost, rarity = excluded.rarity""",
+                    [(typ, int(n), meta["name"], meta.get("cost"), meta.get("rarity")) for n, meta in upsert.items()])
+
+                removed = [int(n) for n in changes.get("remove", [])]
+                voted = {row[0] for row in cur.execute(
+                    "SELECT DISTINCT number FROM voted WHERE type = ? AND number IN (SELECT value FROM json_each(?))",
+                    [typ, json.dumps(removed)])}
+                cur.executemany("DELETE FROM entities WHERE type = ? AND number = ?", [(typ, n) for n in removed if n not in voted])
+
+                # (guild id, number) for upserted things already voted on, or
+                # reserved by a round, somewhere
+                upserted = json.dumps([int(n) for n in upsert])
+                voted_in = set(cur.execute(
+                    """SELECT guild_id, number FROM voted WHERE type = ? AND number IN (SELECT value FROM json_each(?))
+                    UNION SELECT guild_id, number FROM reserved WHERE type = ? AND number IN (SELECT value FROM json_each(?))""",
+                    [typ, upserted, typ, upserted]))
+                changed[typ] = (upsert, removed, voted, voted_in)
+
+        for typ, (upsert, removed, voted, voted_in) in changed.items():
+            manifest = manifests[typ]
+            for number, meta in upsert.items():
+                manifest[str(int(number))] = meta
+            for number in removed:
+                manifest.pop(str(number), None)
+
+            # Costs can change, so anything updated goes back in under its new one
+            for guild_id, state in self.guilds.items():
+                pool = state.pools[typ]
+                for number in removed:
+                    pool.remove(number)
+                for number, meta in upsert.items():
+                    pool.remove(int(number))
+                    if (guild_id, int(number)) not in voted_in:
+                        pool.add(int(number), meta["cost"] if typ == "card" else None)
+
+        # The catalogue is shared without locks, so swap in a whole new one
+        self.catalogue_cache = self.build_catalogue()
+
+        # sync.py wrote these same changes to the manifests, so they and the
+        # tables agree again and there's nothing to ingest next start
+        fingerprints = {typ: fingerprint(path) for typ, path in self.manifest_paths.items()}
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO meta VALUES(?, ?)", self.wanted_meta(fingerprints).items())
+        return {typ: (len(upsert), len(removed)) for typ, (upsert, removed, _, _) in changed.items()}
+
+# DB methods which never write, and so can be served by the read-only connection.
+#
+# Picking and counting candidates isn't here, and nor are guild settings:
+# those are answered from each guild's cached GuildState, which lives next to
+# the writer so it changes along with it.
+# Names aren't here either, use AsyncDB.catalogue directly for those.
+READS = {
+    "get_round_type",
+    "get_summaries",
+    "get_forum_posts",
+    "get_messages",
+    "get_all_messages",
+    "get_ballots",
+    "get_histograms",
+    "get_setting",
+    "get_journal",
+}
+
+# Awaitable front for DB, so the event loop never waits on sqlite.
+#
+# Every write goes through one thread which owns the read-write connection,
+# so writes stay in order. Reads go to a second thread with its own read-only
+# connection, so they don't queue up behind a commit.
+#
+# Call it just like DB, but await the result:
+#
+#     await db.save_ballots(rows)
+class AsyncDB:
+    def __init__(self, fname: str, *args, **kwargs):
+        self.path = fname
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-reader")
+        # sqlite connections belong to the thread that made them, so build each DB on its own thread.
+        # The writer goes first so the schema exists by the time the reader opens.
+        self.db = self.writer.submit(DB, fname, *args, **kwargs).result()
+        self.ro = self.reader.submit(DB, fname, *args, readonly=True, **kwargs).result()
+
+    # Immutable, so fine to read from any thread without going through the
+    # executors. It's partly read from the tables though, so with lazy set it
+    # has to be built on the writer: await load_catalogue() before using it.
+    # Anything that doesn't waits on the writer right there, event loop and all.
+    @property
+    def catalogue(self) -> Catalogue:
+        if self.db.catalogue_cache is None:
+            return self.writer.submit(lambda: self.db.catalogue).result()
+        return self.db.catalogue
+
+    async def load_catalogue(self) -> Catalogue:
+        if self.db.catalogue_cache is None:
+            with metrics.span("db", method="load_catalogue"):
+                await asyncio.get_running_loop().run_in_executor(self.writer, lambda: self.db.catalogue)
+        return self.db.catalogue
+
+    # Just string work, no need for a thread
+    def img_path(self, num: int, typ: str):
+        return self.db.img_path(num, typ)
+
+    def __getattr__(self, name):
+        if name in READS:
+            fn, pool = getattr(self.ro, name), self.reader
+        else:
+            fn, pool = getattr(self.db, name), self.writer
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # Includes waiting for the thread, which is the point: a slow commit shows up on whatever queued behind it
+            with metrics.span("db", method=name):
+                return await loop.run_in_executor(pool, partial(fn, *args, **kwargs))
+        return call
+
+    def close(self):
+        self.reader.submit(self.ro.conn.close).result()
+        self.writer.submit(self.db.conn.close).result()
+        self.reader.shutdown()
+        self.writer.shutdown()
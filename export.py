@@ -0,0 +1,201 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+
+from scoring import trimmed_means
+from tierlist import TIER_NAMES, has_votes, threshold_tier
+
+# Parquet is optional, everything else works without it
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Writes every vote histogram, with the thing's name, cost and rarity and its
+# score and tier, to CSV, JSON Lines or Parquet. One row per thing per guild.
+#
+# It's safe to run next to the bot: it opens its own read-only connection and
+# reads everything inside one transaction, so the export is a consistent
+# snapshot even while rounds finish, and never holds a lock the bot wants.
+# Rows are streamed out a chunk at a time, so memory stays flat however big
+# the database gets.
+#
+#     python export.py data.db votes.csv
+#     python export.py data.db votes.parquet --guild 123 --type card
+
+FORMATS = ["csv", "jsonl", "parquet"]
+
+# Rows fetched, scored and written at a time
+CHUNK_SIZE = 2000
+
+# Cards go up to 10, so CSVs always have this many vote columns
+MAX_SCORE = 10
+
+COLUMNS = ["guild_id", "type", "number", "name", "cost", "rarity", "votes", "removed", "total", "score", "tier"]
+
+def format_for(path: str) -> str:
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    return {"json": "jsonl", "ndjson": "jsonl"}.get(ext, ext)
+
+# In primary key order, so sqlite walks the table rather than sorting it
+def select_histograms(guild_id=None, types=None):
+    sql = """SELECT h.guild_id, h.type, h.number, e.name, e.cost, e.rarity, h.score, h.votes
+        FROM histograms h LEFT JOIN entities e ON e.type = h.type AND e.number = h.number"""
+    where = []
+    params = []
+    if guild_id is not None:
+        where.append("h.guild_id = ?")
+        params.append(guild_id)
+    if types:
+        where.append("h.type IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(types)))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY h.guild_id, h.type, h.number, h.score", params
+
+# Yields one dict per thing, from histogram rows which arrive a score at a time.
+# Scoring is batched, up to chunk_size things of one type per call.
+def things(cur, chunk_size: int = CHUNK_SIZE):
+    batch = []
+
+    def scored():
+        width = max(len(thing["votes"]) for thing in batch)
+        hists = [thing["votes"] + [0] * (width - len(thing["votes"])) for thing in batch]
+        removed, total, average = trimmed_means(hists)
+        for i, thing in enumerate(batch):
+            thing["removed"] = int(removed[i])
+            thing["total"] = int(total[i])
+            thing["score"] = float(average[i])
+            # The same rule as /tierlist, no votes means no tier
+            thing["tier"] = TIER_NAMES[threshold_tier(thing["score"], width)] if has_votes(thing["votes"]) else None
+        out = list(batch)
+        batch.clear()
+        return out
+
+    current = None
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        for guild_id, typ, number, name, cost, rarity, score, votes in rows:
+            key = (guild_id, typ, number)
+            if current is None or current[0] != key:
+                if batch and (len(batch) >= chunk_size or batch[-1]["type"] != typ):
+                    yield from scored()
+                thing = {"guild_id": guild_id, "type": typ, "number": number, "name": name, "cost": cost, "rarity": rarity, "votes": []}
+                batch.append(thing)
+                current = (key, thing)
+            votes_list = current[1]["votes"]
+            # Scores are 1-based, and there shouldn't be gaps, but just in case
+            votes_list.extend([0] * (score - 1 - len(votes_list)))
+            votes_list.append(votes)
+    if batch:
+        yield from scored()
+
+def chunked(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def write_csv(f, rows):
+    vote_columns = [f"votes_{i}" for i in range(1, MAX_SCORE + 1)]
+    header = [c for c in COLUMNS if c != "votes"]
+    writer = csv.writer(f)
+    writer.writerow(header[:6] + vote_columns + header[6:])
+    count = 0
+    for row in rows:
+        votes = row["votes"] + [None] * (MAX_SCORE - len(row["votes"]))
+        writer.writerow([row[c] for c in header[:6]] + votes + [row[c] for c in header[6:]])
+        count += 1
+    return count
+
+def write_jsonl(f, rows):
+    count = 0
+    for row in rows:
+        f.write(json.dumps({c: row[c] for c in COLUMNS}) + "\n")
+        count += 1
+    return count
+
+def write_parquet(path: str, rows, chunk_size: int):
+    schema = pyarrow.schema([
+        ("guild_id", pyarrow.int64()),
+        ("type", pyarrow.string()),
+        ("number", pyarrow.int64()),
+        ("name", pyarrow.string()),
+        ("cost", pyarrow.int64()),
+        ("rarity", pyarrow.string()),
+        ("votes", pyarrow.list_(pyarrow.int64())),
+        ("removed", pyarrow.int64()),
+        ("total", pyarrow.int64()),
+        ("score", pyarrow.float64()),
+        ("tier", pyarrow.string()),
+    ])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunked(rows, chunk_size):
+            writer.write_batch(pyarrow.RecordBatch.from_pylist(chunk, schema=schema))
+            count += len(chunk)
+        if not count:
+            writer.write_table(schema.empty_table())
+    return count
+
+# Exports `db_path` to `out`, returning how many rows were written. The file
+# only appears once it's complete.
+def export(db_path: str, out: str, fmt: str = None, guild_id=None, types=None, chunk_size: int = CHUNK_SIZE) -> int:
+    fmt = fmt or format_for(out)
+    if fmt not in FORMATS:
+        raise ValueError(f"Can't export to {fmt!r}, pick one of {', '.join(FORMATS)}")
+    if fmt == "parquet" and pyarrow is None:
+        raise ValueError("Exporting to Parquet needs pyarrow (pip install pyarrow)")
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    tmp = out + ".tmp"
+    try:
+        # Everything read from here to the rollback comes from one snapshot
+        conn.execute("BEGIN")
+        cur = conn.execute(*select_histograms(guild_id, types))
+        rows = things(cur, chunk_size)
+        if fmt == "parquet":
+            count = write_parquet(tmp, rows, chunk_size)
+        else:
+            with open(tmp, "w", newline="") as f:
+                count = write_csv(f, rows) if fmt == "csv" else write_jsonl(f, rows)
+        conn.rollback()
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        conn.close()
+    os.replace(tmp, out)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Export votes and scores from the bot's database.")
+    parser.add_argument("db", nargs="?", default="data.db")
+    parser.add_argument("out", nargs="?", default="votes.csv", help="file to write, the format comes from its extension")
+    parser.add_argument("--format", choices=FORMATS, default=None, help="override the format the extension implies")
+    parser.add_argument("--guild", type=int, default=None, help="only this guild's votes")
+    parser.add_argument("--type", choices=["card", "map", "sleeve"], action="append", default=None, help="only this type, can be repeated")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    try:
+        count = export(args.db, args.out, args.format, args.guild, args.type, args.chunk_size)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"wrote {count} rows to {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
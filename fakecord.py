@@ -0,0 +1,295 @@
+import asyncio
+import datetime
+import itertools
+import random
+from collections import Counter
+
+import discord
+
+# A stand-in for the bits of Discord the Poller cog talks to, so rounds can be
+# run start to finish without a bot token or a server.
+#
+# Everything that would be an HTTP request goes through a Network, which counts
+# it by route, waits out a configurable latency, and can answer with a 429 some
+# of the time. Like pycord, a 429 is normally waited out and retried behind the
+# caller's back (so it shows up as time, and as an extra request); with
+# surface_429 set it's raised as an HTTPException instead, which is what callers
+# see once pycord gives up.
+#
+#     net = Network(latency=0.05, rate_limit=0.02)
+#     bot = FakeBot(net)
+#     forum = bot.add_channel(FakeForumChannel(net, tags=["1-Cost", "Map"]))
+#     votes = bot.add_channel(FakeTextChannel(net))
+#     cog = Poller(bot, db, ...)
+#     await cog.start.callback(cog, FakeContext(votes), 4, "card")
+
+# Real looking snowflakes, starting from now, so anything checking a message's
+# age (like bulk deletion) sees it as new
+ids = itertools.count(discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc)))
+
+def next_id() -> int:
+    return next(ids)
+
+# Enough of an aiohttp response for discord.HTTPException and friends
+class FakeResponse:
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+class Network:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0, retry_after: float = 0.05, surface_429: bool = False, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        # Chance of any one request getting a 429
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.surface_429 = surface_429
+        self.random = random.Random(seed)
+
+        # route -> requests made, including retried ones
+        self.calls = Counter()
+        self.rate_limited = 0
+
+    async def request(self, route: str):
+        while True:
+            self.calls[route] += 1
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            if self.rate_limit and self.random.random() < self.rate_limit:
+                self.rate_limited += 1
+                if self.surface_429:
+                    raise discord.HTTPException(FakeResponse(429, "Too Many Requests"), "You are being rate limited.")
+                await asyncio.sleep(self.retry_after)
+                continue
+            return
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.rate_limited = 0
+
+def not_found():
+    return discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+
+class FakeUser:
+    def __init__(self, id: int):
+        self.id = id
+
+class FakeReaction:
+    def __init__(self, message, emoji: str, users):
+        self.message = message
+        self.emoji = emoji
+        self.user_ids = users
+
+    @property
+    def count(self) -> int:
+        return len(self.user_ids)
+
+    async def users(self):
+        # One page of up to 100 users per request, like the real thing
+        ids = list(self.user_ids)
+        for start in range(0, max(len(ids), 1), 100):
+            await self.message.channel.network.request("GET /reactions")
+            for user_id in ids[start:start+100]:
+                yield FakeUser(user_id)
+
+class FakeMessage:
+    def __init__(self, channel, content=None, file=None, id=None):
+        self.id = id or next_id()
+        self.channel = channel
+        self.content = content
+        self.file = file
+        # emoji name -> user ids, in the order they reacted
+        self.reacted = {}
+        self.deleted = False
+
+    @property
+    def reactions(self):
+        return [FakeReaction(self, emoji, users) for emoji, users in self.reacted.items() if users]
+
+    # Someone reacting, no request involved
+    def react(self, user_id: int, emoji: str):
+        users = self.reacted.setdefault(emoji, [])
+        if user_id not in users:
+            users.append(user_id)
+
+    def unreact(self, user_id: int, emoji: str):
+        users = self.reacted.get(emoji, [])
+        if user_id in users:
+            users.remove(user_id)
+
+    async def add_reaction(self, emoji):
+        await self.channel.network.request("PUT /reactions")
+        if self.deleted:
+            raise not_found()
+        self.react(self.channel.bot_user_id, getattr(emoji, "name", emoji))
+
+    async def edit(self, **kwargs):
+        await self.channel.network.request("PATCH /message")
+        if self.deleted:
+            raise not_found()
+        if "file" in kwargs:
+            self.file = kwargs["file"]
+        if "content" in kwargs:
+            self.content = kwargs["content"]
+        return self
+
+    async def delete(self):
+        await self.channel.network.request("DELETE /message")
+        if self.deleted:
+            raise not_found()
+        self.channel.forget(self.id)
+
+# What channel.get_partial_message hands back: just an id, nothing fetched
+class FakePartialMessage:
+    def __init__(self, channel, id: int):
+        self.channel = channel
+        self.id = id
+
+    async def delete(self):
+        await self.channel.network.request("DELETE /message")
+        if self.id not in self.channel.messages:
+            raise not_found()
+        self.channel.forget(self.id)
+
+class FakeTextChannel:
+    def __init__(self, network: Network, id=None, name: str = "votes"):
+        self.network = network
+        self.id = id or next_id()
+        self.name = name
+        self.messages = {}
+        self.bot_user_id = 0
+
+    def forget(self, message_id: int):
+        message = self.messages.pop(message_id, None)
+        if message is not None:
+            message.deleted = True
+
+    async def send(self, content=None, file=None, **kwargs):
+        await self.network.request("POST /messages")
+        message = FakeMessage(self, content, file)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, id: int):
+        await self.network.request("GET /message")
+        if id not in self.messages:
+            raise not_found()
+        return self.messages[id]
+
+    def get_partial_message(self, id: int):
+        return FakePartialMessage(self, id)
+
+    async def delete_messages(self, messages):
+        messages = list(messages)
+        await self.network.request("POST /messages/bulk-delete")
+        if not 2 <= len(messages) <= 100:
+            raise discord.HTTPException(FakeResponse(400, "Bad Request"), "Bulk delete takes 2 to 100 messages")
+        for message in messages:
+            self.forget(message.id)
+
+    async def purge(self, **kwargs):
+        await self.network.request("POST /messages/bulk-delete")
+        for id in list(self.messages):
+            self.forget(id)
+
+class FakeThread(FakeTextChannel):
+    def __init__(self, network: Network, parent, name: str, content, applied_tags):
+        super().__init__(network, name=name)
+        self.parent = parent
+        self.applied_tags = applied_tags
+        self.locked = False
+        self.archived = False
+        self.bot_user_id = parent.bot_user_id
+        # The starter message shares the thread's id
+        self.messages[self.id] = FakeMessage(self, content, id=self.id)
+
+    async def edit(self, **kwargs):
+        await self.network.request("PATCH /channel")
+        self.locked = kwargs.get("locked", self.locked)
+        self.archived = kwargs.get("archived", self.archived)
+        return self
+
+    async def delete(self):
+        await self.network.request("DELETE /channel")
+        self.parent.threads.pop(self.id, None)
+
+class FakeTag:
+    def __init__(self, name: str):
+        self.id = next_id()
+        self.name = name
+
+class FakeForumChannel:
+    def __init__(self, network: Network, id=None, tags=(), name: str = "tier-list"):
+        self.network = network
+        self.id = id or next_id()
+        self.name = name
+        self.available_tags = [FakeTag(t) for t in tags]
+        self.threads = {}
+        self.bot_user_id = 0
+
+    async def create_thread(self, name: str, content=None, applied_tags=(), **kwargs):
+        await self.network.request("POST /threads")
+        thread = FakeThread(self.network, self, name, content, applied_tags)
+        self.threads[thread.id] = thread
+        return thread
+
+class FakeBot:
+    def __init__(self, network: Network):
+        self.network = network
+        self.user = FakeUser(next_id())
+        self.channels = {}
+
+    def add_channel(self, channel):
+        channel.bot_user_id = self.user.id
+        self.channels[channel.id] = channel
+        return channel
+
+    # From the cache, so no request
+    def get_channel(self, id: int):
+        return self.channels.get(id)
+
+    async def fetch_channel(self, id: int):
+        await self.network.request("GET /channel")
+        if id in self.channels:
+            return self.channels[id]
+        for channel in self.channels.values():
+            if id in getattr(channel, "threads", {}):
+                return channel.threads[id]
+        raise not_found()
+
+class FakeGuild:
+    def __init__(self, id=None):
+        self.id = id or next_id()
+
+# An application command invocation. Responses are kept in `responses`.
+class FakeContext:
+    def __init__(self, channel: FakeTextChannel, guild: FakeGuild = None):
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = guild or FakeGuild()
+        self.guild_id = self.guild.id
+        self.responses = []
+        self.deferred = False
+
+    async def respond(self, content=None, **kwargs):
+        await self.channel.network.request("POST /interaction")
+        self.responses.append(content)
+
+    async def defer(self, **kwargs):
+        await self.channel.network.request("POST /interaction")
+        self.deferred = True
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+# What a user reacting looks like to raw reaction listeners
+class FakeReactionEvent:
+    def __init__(self, message: FakeMessage, user_id: int, emoji: str):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.user_id = user_id
+        self.emoji = discord.PartialEmoji(name=emoji)
@@ -1,11 +1,24 @@
 import os
 
-from bot import bot, setup
-from db import DB
+from assets import AssetCache
+from bot import make_bot, setup
+from db import AsyncDB
 
 # The file to store the backing data in
 SQLITE_FILE = "data.db"
 
+# sqlite pragmas to use on top of db.DEFAULT_STORAGE_PROFILE,
+# e.g. {"synchronous": "FULL"} to fsync on every commit
+STORAGE_PROFILE = {}
+
+# The guild (server) id whose votes are already in SQLITE_FILE from before the
+# bot kept track of guilds. Set this once when upgrading, None otherwise.
+LEGACY_GUILD_ID = None
+
+# When True, the manifests are only read and the unvoted pools only built once
+# something needs them, so the bot gets back online faster after a restart
+LAZY_LOAD = False
+
 # The path to the JSON card metadata manifest
 MANIFEST_PATH = "manifest.json"
 
@@ -18,12 +31,47 @@ SLEEVE_MANIFEST_PATH = "sleeve_manifest.json"
 # The path to a folder containing all the cards' images
 GALLERY_PATH = "gallery"
 
+# Where sync.py leaves manifest and gallery changes for /sync to pick up
+MANIFEST_DIFF_PATH = "manifest_diff.json"
+
+# Where to keep the thumbnail atlas used to draw tier list images
+ATLAS_PATH = ".atlas"
+
+# How many bytes of gallery images to keep in memory
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# PNGs bigger than this many bytes are shrunk and sent as WebP instead, None to always send the original
+TRANSCODE_PNG_OVER = 128 * 1024
+
 # When True, delete our own messages after tallying the votes on them
 SHOULD_DELETE_MESSAGES = True
 
+# When True, a command issued while another is running in the same channel
+# waits its turn; when False it is turned away with a "busy" reply
+QUEUE_BUSY_COMMANDS = False
+
+# When True, run as an AutoShardedBot so one process can serve many guilds
+SHARDED = False
+
+# How many shards to run with SHARDED, None to use as many as Discord recommends
+SHARD_COUNT = None
+
+# Where /export saves files it can't (or wasn't asked to) attach
+EXPORT_PATH = "exports"
+
+# Serve metrics in Prometheus' format on this localhost port, None for no server
+METRICS_PORT = None
+
+# Write metrics to this file as JSON every minute, None to not
+METRICS_JSON_PATH = None
+
 def main():
-    db = DB(SQLITE_FILE, MANIFEST_PATH, MAPIFEST_PATH, SLEEVE_MANIFEST_PATH, GALLERY_PATH)
-    setup(bot, db, should_delete_messages = SHOULD_DELETE_MESSAGES)
+    db = AsyncDB(SQLITE_FILE, MANIFEST_PATH, MAPIFEST_PATH, SLEEVE_MANIFEST_PATH, GALLERY_PATH, storage_profile = STORAGE_PROFILE, lazy = LAZY_LOAD,
+                 legacy_guild_id = LEGACY_GUILD_ID)
+    bot = make_bot(SHARDED, SHARD_COUNT)
+    setup(bot, db, should_delete_messages = SHOULD_DELETE_MESSAGES, queue_busy_commands = QUEUE_BUSY_COMMANDS, atlas_path = ATLAS_PATH,
+          assets = AssetCache(IMAGE_CACHE_BYTES, TRANSCODE_PNG_OVER), diff_path = MANIFEST_DIFF_PATH,
+          metrics_port = METRICS_PORT, metrics_json_path = METRICS_JSON_PATH, export_path = EXPORT_PATH)
     bot.run(os.getenv("TABLE_TURF_TOKEN"))
 
 if __name__ == "__main__":
@@ -1,6 +1,12 @@
-import re
-import os
+import argparse
+import difflib
+import functools
 import json
+import os
+import re
+import sys
+
+from catalogue import normalize
 
 one = """Splat Bomb
 Suction Bomb
@@ -209,29 +215,67 @@ DJ Octavio"""
 
 costs = [x.split("\n") for x in [one, two, three, four, five, six]]
 
+# Names as they show up in file names don't always match the lists above
+# exactly: case, curly apostrophes, stray punctuation. So lookups go by a key
+# with all of that stripped out.
+def cost_key(name: str) -> str:
+    return re.sub(r"[^\w]", "", normalize(name))
+
+# cost key -> (name as listed, cost), built once
+cost_index = {}
+for i, names in enumerate(costs):
+    for item in names:
+        if item:
+            cost_index.setdefault(cost_key(item), (item, i+1))
+
+# (cost, listed name it matched, how it matched), cost is -1 if nothing did.
+#
+# Exact and normalized matches are a dict lookup. Anything else gets one go at
+# a close match before giving up, which is the only slow path - and the
+# answer is remembered, so the same name is never fuzzy matched twice.
+@functools.lru_cache(maxsize=None)
+def resolve_cost(name: str, cutoff: float = 0.85):
+    key = cost_key(name)
+    match = cost_index.get(key)
+    if match:
+        return match[1], match[0], "exact" if match[0] == name else "normalized"
+    close = difflib.get_close_matches(key, cost_index.keys(), n=1, cutoff=cutoff)
+    if close:
+        listed, cost = cost_index[close[0]]
+        return cost, listed, "fuzzy"
+    return -1, None, None
+
 def cost_for(name):
-    for i in range(len(costs)):
-        for item in costs[i]:
-            if item == name:
-                return i+1
-    return -1
+    return resolve_cost(name)[0]
 
 def main():
+    parser = argparse.ArgumentParser(description="Build the card manifest from freshly downloaded card images.")
+    parser.add_argument("--gallery", default="gallery")
+    parser.add_argument("--manifest", default="manifest.json")
+    parser.add_argument("--report", default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
     manifest = {}
+    # Everything that needed more than an exact match, so a human can check it
+    fuzzy = []
+    unresolved = []
 
-    prog = re.compile("No. (\d+) (.*) \((.*)\).jpg")
+    prog = re.compile(r"No. (\d+) (.*) \((.*)\).jpg")
 
-    for _root, _dirs, files in os.walk("gallery"):
-        for fname in files:
-            result = prog.match(fname)
+    with os.scandir(args.gallery) as it:
+        for entry in it:
+            result = prog.match(entry.name)
             if not result:
                 continue
-            
-            
+
             number = int(result.group(1))
             name = result.group(2)
             rarity = result.group(3)
-            cost = cost_for(name)
+            cost, listed, how = resolve_cost(name)
+            if how is None:
+                unresolved.append({"file": entry.name, "number": number, "name": name})
+            elif how == "fuzzy":
+                fuzzy.append({"file": entry.name, "number": number, "name": name, "matched": listed, "cost": cost})
 
             manifest[number] = {
                 "name": name,
@@ -239,10 +283,17 @@ def main():
                 "cost": cost,
             }
 
-            os.rename(os.path.join("gallery", fname), os.path.join("gallery", f"{number}.jpg"))
+            os.rename(entry.path, os.path.join(args.gallery, f"{number}.jpg"))
 
-    with open("manifest.json", "w") as f:
+    with open(args.manifest, "w") as f:
         f.write(json.dumps(manifest, indent=4))
 
+    report = json.dumps({"cards": len(manifest), "fuzzy": fuzzy, "unresolved": unresolved}, indent=4)
+    print(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(report)
+    return 1 if unresolved else 0
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
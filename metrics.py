@@ -0,0 +1,274 @@
+import asyncio
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Timings and counts for the hot paths, so a slow /start or /stop can be
+# pinned on Discord, reactions, forum threads, sqlite or the disk.
+#
+#     with metrics.span("start", phase="post_votes"):
+#         ...
+#     metrics.inc("reactions_failed")
+#
+# Everything records into the module-level `registry`. It can be scraped in
+# Prometheus' text format from serve(), dumped as JSON with dump(), and there's
+# a sampling Profiler for when the numbers aren't enough.
+
+# Upper bounds, in seconds, of the buckets span timings are counted into
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+PREFIX = "tableturf_"
+
+def label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+class Registry:
+    def __init__(self):
+        # Spans end on DB threads as well as the event loop
+        self.lock = threading.Lock()
+        # name -> label key -> value
+        self.counters = collections.defaultdict(dict)
+        # name -> label key -> Timing
+        self.timings = collections.defaultdict(dict)
+        # name -> callable returning {label key: value}, read at export time
+        self.gauges = {}
+
+    def inc(self, metric: str, value: float = 1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.counters[metric][key] = self.counters[metric].get(key, 0) + value
+
+    def observe(self, metric: str, seconds: float, **labels):
+        key = label_key(labels)
+        with self.lock:
+            timing = self.timings[metric].get(key)
+            if timing is None:
+                timing = self.timings[metric][key] = Timing()
+            timing.observe(seconds)
+
+    # Times the block, counting it as an error (and re-raising) if it raises
+    @contextmanager
+    def span(self, metric: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(metric + "_errors", **labels)
+            raise
+        finally:
+            self.observe(metric, time.perf_counter() - start, **labels)
+
+    # fn() should return a number, or {label: value} for a gauge split by one label
+    def gauge(self, metric: str, fn, label: str = None):
+        def read():
+            value = fn()
+            if label is None:
+                return {(): value}
+            return {((label, k),): v for k, v in value.items()}
+        self.gauges[metric] = read
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+            timings = {name: {k: (t.count, t.sum, t.max, list(t.buckets)) for k, t in values.items()} for name, values in self.timings.items()}
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                # A broken gauge shouldn't take the rest of the metrics down with it
+                continue
+        return {"counters": counters, "timings": timings, "gauges": gauges}
+
+    # Prometheus' text exposition format
+    def render(self) -> str:
+        snap = self.snapshot()
+        lines = []
+        for name, values in sorted(snap["counters"].items()):
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            for key, value in values.items():
+                lines.append(f"{PREFIX}{name}_total{format_labels(key)} {value}")
+        for name, values in sorted(snap["gauges"].items()):
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            for key, value in values.items():
+                lines.append(f"{PREFIX}{name}{format_labels(key)} {value}")
+        for name, values in sorted(snap["timings"].items()):
+            metric = f"{PREFIX}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for key, (count, total, _, buckets) in values.items():
+                cumulative = 0
+                for bound, n in zip(BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(f"{metric}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric}_bucket{format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{metric}_sum{format_labels(key)} {total}")
+                lines.append(f"{metric}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    # The same as a dict, for dumping as JSON
+    def as_dict(self) -> dict:
+        snap = self.snapshot()
+        def name_of(name, key):
+            return name + format_labels(key)
+        out = {"time": time.time(), "counters": {}, "gauges": {}, "timings": {}}
+        for name, values in snap["counters"].items():
+            for key, value in values.items():
+                out["counters"][name_of(name, key)] = value
+        for name, values in snap["gauges"].items():
+            for key, value in values.items():
+                out["gauges"][name_of(name, key)] = value
+        for name, values in snap["timings"].items():
+            for key, (count, total, longest, _) in values.items():
+                out["timings"][name_of(name, key)] = {
+                    "count": count,
+                    "total_seconds": total,
+                    "avg_seconds": total / count if count else 0.0,
+                    "max_seconds": longest,
+                }
+        return out
+
+    def dump(self, path: str):
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps(self.as_dict(), indent=4))
+        # A reader never sees half a file
+        os.replace(path + ".tmp", path)
+
+registry = Registry()
+
+# Times consecutive phases of one long function without re-indenting it into
+# a pile of `with` blocks. Each mark counts the time since the last one:
+#
+#     phases = metrics.Phases("start")
+#     ...
+#     phases.mark("pick")
+#     ...
+#     phases.mark("post")
+class Phases:
+    def __init__(self, name: str, reg: Registry = None):
+        self.name = name
+        self.reg = reg or registry
+        self.last = time.perf_counter()
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.reg.observe(self.name, now - self.last, phase=phase)
+        self.last = now
+
+span = registry.span
+inc = registry.inc
+observe = registry.observe
+gauge = registry.gauge
+
+# A bare-bones HTTP server answering GET /metrics (or anything else) with
+# registry.render(). Bind it to localhost and let a scraper or ssh tunnel in.
+async def serve(host: str = "127.0.0.1", port: int = 9108, reg: Registry = registry):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Headers aren't interesting, just wait for the end of them
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            body = reg.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+# Samples one thread's stack every `interval` seconds, from a background thread,
+# and counts how often each stack shows up. Cheap enough to leave running for
+# a while in production, and needs nothing outside the standard library.
+#
+# folded() gives the "frame;frame;frame count" lines flamegraph.pl and
+# speedscope read, top() the functions seen most often.
+class Profiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.started_at = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    # Profile the calling thread, normally the one running the event loop
+    def start(self, thread_id: int = None):
+        if self.running:
+            return
+        target = thread_id or threading.get_ident()
+        self.stacks.clear()
+        self.samples = 0
+        self.stopping.clear()
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self.run, args=(target,), name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self, target: int):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+    # [(function, samples it was on the stack for, samples it was running in), ...]
+    def top(self, n: int = 15):
+        inclusive = collections.Counter()
+        exclusive = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            exclusive[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+        return [(frame, inclusive[frame], exclusive[frame]) for frame, _ in exclusive.most_common(n)]
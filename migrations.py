@@ -0,0 +1,293 @@
+import argparse
+import sqlite3
+import sys
+
+# Moves data.db files from one schema version to the next.
+#
+# Each migration copies in chunks, each chunk its own small transaction that
+# also records how far it got, so:
+#
+# - nothing holds the write lock for long, and a bot (even an old one) can
+#   keep using the database while this runs next to it
+# - a crash or ^C part way through loses nothing, running it again picks up
+#   where it stopped
+#
+# Only the last step of a migration, which drops the old tables and bumps
+# the version, is one big transaction, and it first catches up on anything
+# written while the chunks were being copied.
+#
+# The bot runs this on start, or run it by hand ahead of time:
+#
+#     python migrations.py data.db
+
+CHUNK_SIZE = 5000
+
+def ensure_meta(conn: sqlite3.Connection):
+    conn.execute("""CREATE TABLE IF NOT EXISTS meta(
+        key VARCHAR(255) PRIMARY KEY,
+        value VARCHAR(255)
+    )""")
+    conn.commit()
+
+def get_meta(conn: sqlite3.Connection, key: str, default=None):
+    res = conn.execute("SELECT value FROM meta WHERE key = ?", [key]).fetchone()
+    return default if res is None else res[0]
+
+def set_meta(conn: sqlite3.Connection, key: str, value):
+    conn.execute("INSERT OR REPLACE INTO meta VALUES(?, ?)", [key, str(value)])
+
+def has_table(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name]).fetchone() is not None
+
+# Copies `select` (which must take the last rowid copied and a limit, and hand
+# back rowid first) into `insert` a chunk at a time. Where it got to is kept in
+# meta under `key`, so it resumes rather than starting over.
+def copy_chunked(conn: sqlite3.Connection, key: str, select: str, insert: str, chunk_size: int = CHUNK_SIZE):
+    copied = 0
+    while True:
+        last = int(get_meta(conn, key, -1))
+        with conn:
+            rows = conn.execute(select, [last, chunk_size]).fetchall()
+            if not rows:
+                return copied
+            conn.executemany(insert, [row[1:] for row in rows])
+            set_meta(conn, key, rows[-1][0])
+        copied += len(rows)
+
+# 1 -> 2: one `entities` table and one `histograms` table, keyed by type,
+# instead of a table of each per type. Single-row tables used as globals
+# become rows in `settings`.
+#
+# The old table names live on as views, so anything reading them still works.
+def unify_types(conn: sqlite3.Connection, chunk_size: int = CHUNK_SIZE):
+    with conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS entities(
+            type VARCHAR(255),
+            number INTEGER,
+            name VARCHAR(255),
+            cost INTEGER,
+            rarity VARCHAR(255),
+            voted INTEGER,
+            PRIMARY KEY (type, number)
+        )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS histograms(
+            type VARCHAR(255),
+            number INTEGER,
+            score INTEGER,
+            votes INTEGER,
+            PRIMARY KEY (type, number, score)
+        ) WITHOUT ROWID""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS settings(
+            key VARCHAR(255) PRIMARY KEY,
+            value
+        )""")
+
+    things = [("card", "cards", "cost, rarity"), ("map", "maps", "NULL, NULL"), ("sleeve", "sleeves", "NULL, NULL")]
+    votes = [("card", "votes"), ("map", "map_votes"), ("sleeve", "sleeve_votes")]
+
+    def copy_things(typ, table, extra):
+        return copy_chunked(conn, f"migration:2:{table}",
+            f"SELECT rowid, '{typ}', number, name, {extra}, voted FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            "INSERT OR REPLACE INTO entities VALUES(?, ?, ?, ?, ?, ?)", chunk_size)
+
+    def copy_votes(typ, table):
+        return copy_chunked(conn, f"migration:2:{table}",
+            f"SELECT rowid, '{typ}', number, score, votes FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            "INSERT OR REPLACE INTO histograms VALUES(?, ?, ?, ?)", chunk_size)
+
+    for typ, table, extra in things:
+        if has_table(conn, table):
+            copy_things(typ, table, extra)
+    for typ, table in votes:
+        if has_table(conn, table):
+            copy_votes(typ, table)
+
+    # Everything else in one go. Anything written since the chunks were copied
+    # is new rows (the old code only ever INSERT OR REPLACEd, which gives the
+    # row a new rowid) or voted flags flipping, so catch up on exactly those.
+    # Taking the write lock up front means nothing else can sneak in meanwhile.
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for typ, table, extra in things:
+            if not has_table(conn, table):
+                continue
+            last = int(get_meta(conn, f"migration:2:{table}", -1))
+            conn.execute(f"INSERT OR REPLACE INTO entities SELECT '{typ}', number, name, {extra}, voted FROM {table} WHERE rowid > ?", [last])
+            conn.execute(f"UPDATE entities SET voted = 1 WHERE type = ? AND number IN (SELECT number FROM {table} WHERE voted = 1)", [typ])
+            conn.execute(f"DROP TABLE {table}")
+        for typ, table in votes:
+            if not has_table(conn, table):
+                continue
+            last = int(get_meta(conn, f"migration:2:{table}", -1))
+            conn.execute(f"INSERT OR REPLACE INTO histograms SELECT '{typ}', number, score, votes FROM {table} WHERE rowid > ?", [last])
+            conn.execute(f"DROP TABLE {table}")
+
+        if has_table(conn, "forum_chan"):
+            res = conn.execute("SELECT channel_id FROM forum_chan").fetchone()
+            if res:
+                conn.execute("INSERT OR IGNORE INTO settings VALUES('forum_chan', ?)", [res[0]])
+            conn.execute("DROP TABLE forum_chan")
+        if has_table(conn, "round_type"):
+            res = conn.execute("SELECT thing FROM round_type").fetchone()
+            if res:
+                conn.execute("INSERT OR IGNORE INTO settings VALUES('round_type', ?)", [res[0]])
+            conn.execute("DROP TABLE round_type")
+
+        create_v2_views(conn)
+        conn.execute("DELETE FROM meta WHERE key LIKE 'migration:2:%'")
+        set_meta(conn, "schema_version", 2)
+
+# 3 -> 4: forum threads get the voting channel they belong to and a state,
+# so /stop only locks its own round's and locked ones can be let go of.
+# Threads already here could be from any channel and any round, so they're
+# left open with no channel, and the next /stop anywhere locks them one last time.
+def add_thread_state(conn: sqlite3.Connection, chunk_size: int = CHUNK_SIZE):
+    if not has_table(conn, "forum_posts"):
+        return
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(forum_posts)")]
+    with conn:
+        if "channel_id" not in columns:
+            conn.execute("ALTER TABLE forum_posts ADD COLUMN channel_id INTEGER")
+        if "state" not in columns:
+            conn.execute("ALTER TABLE forum_posts ADD COLUMN state VARCHAR(255) DEFAULT 'open'")
+        set_meta(conn, "schema_version", 4)
+
+# 4 -> 5: everything people vote on belongs to a guild, so one bot can run
+# a tier list in several servers at once. Histograms are keyed by guild first,
+# voted flags move out of entities (which stay shared) into their own table,
+# and the forum channel becomes a per guild setting.
+#
+# Whoever's data this already is isn't known here, so it all goes under guild
+# 0 until the bot is told which guild that is (see LEGACY_GUILD_ID in main.py).
+#
+# histograms is at most ten rows per thing, so it's copied in one go along
+# with everything else; even a big one takes well under a second.
+def partition_by_guild(conn: sqlite3.Connection, chunk_size: int = CHUNK_SIZE):
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        drop_views(conn)
+
+        conn.execute("""CREATE TABLE guild_histograms(
+            guild_id INTEGER,
+            type VARCHAR(255),
+            number INTEGER,
+            score INTEGER,
+            votes INTEGER,
+            PRIMARY KEY (guild_id, type, number, score)
+        ) WITHOUT ROWID""")
+        conn.execute("INSERT INTO guild_histograms SELECT 0, type, number, score, votes FROM histograms")
+        conn.execute("DROP TABLE histograms")
+        conn.execute("ALTER TABLE guild_histograms RENAME TO histograms")
+
+        conn.execute("""CREATE TABLE IF NOT EXISTS voted(
+            guild_id INTEGER,
+            type VARCHAR(255),
+            number INTEGER,
+            PRIMARY KEY (guild_id, type, number)
+        ) WITHOUT ROWID""")
+        conn.execute("INSERT OR IGNORE INTO voted SELECT 0, type, number FROM entities WHERE voted = 1")
+
+        conn.execute("""CREATE TABLE shared_entities(
+            type VARCHAR(255),
+            number INTEGER,
+            name VARCHAR(255),
+            cost INTEGER,
+            rarity VARCHAR(255),
+            PRIMARY KEY (type, number)
+        )""")
+        conn.execute("INSERT INTO shared_entities SELECT type, number, name, cost, rarity FROM entities")
+        conn.execute("DROP TABLE entities")
+        conn.execute("ALTER TABLE shared_entities RENAME TO entities")
+
+        conn.execute("""CREATE TABLE IF NOT EXISTS guild_settings(
+            guild_id INTEGER,
+            key VARCHAR(255),
+            value,
+            PRIMARY KEY (guild_id, key)
+        )""")
+        conn.execute("INSERT OR IGNORE INTO guild_settings SELECT 0, key, value FROM settings WHERE key = 'forum_chan'")
+        conn.execute("DELETE FROM settings WHERE key = 'forum_chan'")
+
+        if has_table(conn, "rounds"):
+            conn.execute("ALTER TABLE rounds ADD COLUMN guild_id INTEGER DEFAULT 0")
+
+        create_views(conn)
+        set_meta(conn, "schema_version", 5)
+
+VIEWS = ["votes", "map_votes", "sleeve_votes", "cards", "maps", "sleeves"]
+
+def drop_views(conn: sqlite3.Connection):
+    for view in VIEWS:
+        conn.execute(f"DROP VIEW IF EXISTS {view}")
+
+# The views unify_types leaves behind, over the version 2 tables
+def create_v2_views(conn: sqlite3.Connection):
+    for typ, table in [("card", "votes"), ("map", "map_votes"), ("sleeve", "sleeve_votes")]:
+        conn.execute(f"CREATE VIEW IF NOT EXISTS {table} AS SELECT number, score, votes FROM histograms WHERE type = '{typ}'")
+    conn.execute("CREATE VIEW IF NOT EXISTS cards AS SELECT number, name, cost, rarity, voted FROM entities WHERE type = 'card'")
+    conn.execute("CREATE VIEW IF NOT EXISTS maps AS SELECT number, name, voted FROM entities WHERE type = 'map'")
+    conn.execute("CREATE VIEW IF NOT EXISTS sleeves AS SELECT number, name, voted FROM entities WHERE type = 'sleeve'")
+
+# The old per-type tables as views over the current ones. They predate guilds,
+# so votes are summed over every guild, and voted means voted on anywhere.
+def create_views(conn: sqlite3.Connection):
+    for typ, table in [("card", "votes"), ("map", "map_votes"), ("sleeve", "sleeve_votes")]:
+        conn.execute(f"""CREATE VIEW IF NOT EXISTS {table} AS
+            SELECT number, score, SUM(votes) AS votes FROM histograms WHERE type = '{typ}' GROUP BY number, score""")
+    voted = "EXISTS (SELECT 1 FROM voted v WHERE v.type = e.type AND v.number = e.number) AS voted"
+    conn.execute(f"CREATE VIEW IF NOT EXISTS cards AS SELECT number, name, cost, rarity, {voted} FROM entities e WHERE type = 'card'")
+    conn.execute(f"CREATE VIEW IF NOT EXISTS maps AS SELECT number, name, {voted} FROM entities e WHERE type = 'map'")
+    conn.execute(f"CREATE VIEW IF NOT EXISTS sleeves AS SELECT number, name, {voted} FROM entities e WHERE type = 'sleeve'")
+
+# version it moves *to* -> migration. Versions which only add tables or
+# indexes don't need one, DB.create_schema adds those.
+MIGRATIONS = {
+    2: unify_types,
+    4: add_thread_state,
+    5: partition_by_guild,
+}
+
+LATEST = max(MIGRATIONS)
+
+# The version a database is at. Databases from before versions were recorded
+# are 1 if they have any tables at all, and None if they're brand new - those
+# don't need migrating, just creating.
+def current_version(conn: sqlite3.Connection):
+    if has_table(conn, "meta"):
+        version = get_meta(conn, "schema_version")
+        if version is not None:
+            return int(version)
+    if has_table(conn, "cards") or has_table(conn, "votes"):
+        return 1
+    return None
+
+# Runs every migration between where the database is and `target`. Returns the
+# versions it ran.
+def migrate(conn: sqlite3.Connection, target: int = LATEST, chunk_size: int = CHUNK_SIZE):
+    version = current_version(conn)
+    if version is None:
+        return []
+    ensure_meta(conn)
+    ran = []
+    for to in range(version + 1, target + 1):
+        if to not in MIGRATIONS:
+            continue
+        print(f"migrating {to - 1} -> {to}")
+        MIGRATIONS[to](conn, chunk_size)
+        ran.append(to)
+    return ran
+
+def main():
+    parser = argparse.ArgumentParser(description="Bring a database up to the latest schema.")
+    parser.add_argument("db", nargs="?", default="data.db")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows copied per transaction")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    ran = migrate(conn, LATEST, args.chunk_size)
+    print(f"at version {current_version(conn)}" + ("" if ran else ", nothing to do"))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import random
+
+# The numbers which haven't been voted on yet, bucketed by key (cost for
+# cards; maps and sleeves all go in one bucket).
+#
+# Each bucket is a plain list, and removal swaps with the last element, so
+# sampling k things and marking them voted is O(k) however big the catalogue gets.
+class UnvotedPool:
+    def __init__(self, rows=()):
+        # key -> [number, ...]
+        self.buckets = {}
+        # number -> (key, index into its bucket)
+        self.where = {}
+        for number, key in rows:
+            self.add(number, key)
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, number):
+        return number in self.where
+
+    def add(self, number, key=None):
+        if number in self.where:
+            return
+        bucket = self.buckets.setdefault(key, [])
+        self.where[number] = (key, len(bucket))
+        bucket.append(number)
+
+    def remove(self, number):
+        if number not in self.where:
+            return
+        key, idx = self.where.pop(number)
+        bucket = self.buckets[key]
+        last = bucket.pop()
+        if last != number:
+            bucket[idx] = last
+            self.where[last] = (key, idx)
+        if not bucket:
+            del self.buckets[key]
+
+    def sample(self, k, key=None):
+        bucket = self.buckets.get(key, [])
+        return random.sample(bucket, min(k, len(bucket)))
+
+    def count(self, key=None):
+        return len(self.buckets.get(key, []))
+
+    def lowest_key(self):
+        return min(self.buckets) if self.buckets else None
+
+    # (lowest key, how many it holds) as if `numbers` were already gone,
+    # or (None, 0) if that would leave nothing.
+    def lowest_after(self, numbers):
+        gone = {}
+        for n in set(numbers):
+            if n in self.where:
+                key = self.where[n][0]
+                gone[key] = gone.get(key, 0) + 1
+        for key in sorted(self.buckets):
+            left = len(self.buckets[key]) - gone.get(key, 0)
+            if left > 0:
+                return key, left
+        return None, 0
+
+    def count_after(self, numbers):
+        return len(self.where) - len({n for n in numbers if n in self.where})
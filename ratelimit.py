@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+import discord
+
+# Paces reaction requests so a round doesn't slam into Discord's rate limits.
+#
+# Adding reactions is bucketed per channel, and that bucket only allows about one
+# request every quarter second. Firing every keycap for every message at once
+# just turns into a pile of 429s and retries. Instead each channel gets one FIFO
+# queue and one worker draining it at the bucket's pace, retrying failures with
+# exponential backoff.
+class ReactionScheduler:
+    def __init__(self, interval: float = 0.25, attempts: int = 4, backoff: float = 0.5):
+        self.interval = interval
+        self.attempts = attempts
+        self.backoff = backoff
+
+        # channel id -> asyncio.Queue of pending reactions
+        self.buckets = {}
+        # channel id -> worker task, only while that queue has work
+        self.workers = {}
+        # channel id -> earliest time we may hit that bucket again
+        self.next_at = {}
+
+        # Metrics
+        self.in_flight = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.buckets.values()) + self.in_flight
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth(),
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+            "wait_seconds_total": self.wait_total,
+            "wait_seconds_max": self.wait_max,
+            "wait_seconds_avg": self.wait_total / self.waited if self.waited else 0.0,
+        }
+
+    # Queue up reactions on a message, returning one future per emoji which
+    # resolves to whether that reaction made it on.
+    def submit(self, msg: discord.Message, emojis):
+        key = msg.channel.id
+        queue = self.buckets.setdefault(key, asyncio.Queue())
+        loop = asyncio.get_running_loop()
+        futs = []
+        for emoji in emojis:
+            fut = loop.create_future()
+            queue.put_nowait((msg, emoji, fut, time.monotonic()))
+            futs.append(fut)
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self.work(key))
+        return futs
+
+    # Add the reactions in order, returning whichever ones we gave up on
+    async def seed(self, msg: discord.Message, emojis):
+        results = await asyncio.gather(*self.submit(msg, emojis))
+        return [e for e, ok in zip(emojis, results) if not ok]
+
+    async def work(self, key):
+        queue = self.buckets[key]
+        fut = None
+        try:
+            while not queue.empty():
+                msg, emoji, fut, queued_at = queue.get_nowait()
+                self.in_flight += 1
+                try:
+                    ok = await self.send(key, msg, emoji)
+                finally:
+                    self.in_flight -= 1
+                waited = time.monotonic() - queued_at
+                self.waited += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                if not fut.done():
+                    fut.set_result(ok)
+        finally:
+            del self.workers[key]
+            # If the worker died (cancelled, most likely) don't leave anyone
+            # waiting on it, everything it didn't get to counts as failed
+            leftover = [fut] if fut is not None and not fut.done() else []
+            while not queue.empty():
+                leftover.append(queue.get_nowait()[2])
+            for fut in leftover:
+                if not fut.done():
+                    self.failed += 1
+                    fut.set_result(False)
+            del self.buckets[key]
+
+    async def send(self, key, msg: discord.Message, emoji) -> bool:
+        for attempt in range(self.attempts):
+            delay = self.next_at.get(key, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_at[key] = time.monotonic() + self.interval
+            try:
+                await msg.add_reaction(emoji)
+                self.sent += 1
+                return True
+            except (discord.NotFound, discord.Forbidden):
+                # Retrying won't bring the message back or give us permission
+                break
+            except Exception:
+                # 429s and 5xxs, but also timeouts and dropped connections
+                if attempt + 1 < self.attempts:
+                    self.retries += 1
+                self.next_at[key] = time.monotonic() + self.backoff * 2**attempt
+        self.failed += 1
+        return False
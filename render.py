@@ -0,0 +1,184 @@
+import io
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Draws tier lists as images, out of the pictures in the gallery.
+#
+# Decoding 200 JPEGs and PNGs and scaling them down is most of the cost of
+# drawing one, so every thumbnail is decoded once into an atlas: one flat file
+# of raw RGB thumbnails, all the same size, next to an index of which slot holds
+# what and the mtime of the file it came from. The atlas is memory-mapped, so
+# rendering only copies pixels, and only thumbnails whose source changed are
+# ever decoded again.
+
+THUMB_SIZE = (72, 100)
+BACKGROUND = (30, 30, 36)
+LABEL_WIDTH = 64
+PADDING = 4
+
+TIER_COLOURS = {
+    "S": (255, 127, 127),
+    "A": (255, 191, 127),
+    "B": (255, 223, 127),
+    "C": (255, 255, 127),
+    "D": (191, 255, 127),
+    "F": (127, 191, 255),
+}
+
+# Stands in for the mtime of a source that isn't there
+MISSING = -1
+
+# What's drawn for something with no picture, e.g. a card sync.py removed
+# after it was voted on
+def make_placeholder(size=THUMB_SIZE) -> bytes:
+    thumb = Image.new("RGB", size, BACKGROUND)
+    draw = ImageDraw.Draw(thumb)
+    draw.rectangle((0, 0, size[0] - 1, size[1] - 1), outline=(90, 90, 100), width=2)
+    font = ImageFont.load_default(size=size[1] // 3)
+    left, top, right, bottom = draw.textbbox((0, 0), "?", font=font)
+    draw.text(((size[0] - (right - left)) // 2 - left, (size[1] - (bottom - top)) // 2 - top), "?", fill=(160, 160, 170), font=font)
+    return thumb.tobytes()
+
+def make_thumbnail(path: str, size=THUMB_SIZE) -> bytes:
+    with Image.open(path) as im:
+        im = im.convert("RGBA")
+        im.thumbnail(size)
+        thumb = Image.new("RGB", size, BACKGROUND)
+        thumb.paste(im, ((size[0] - im.width) // 2, (size[1] - im.height) // 2), im)
+        return thumb.tobytes()
+
+class Atlas:
+    def __init__(self, cache_path: str, size=THUMB_SIZE):
+        self.size = size
+        self.slot_bytes = size[0] * size[1] * 3
+        os.makedirs(cache_path, exist_ok=True)
+        name = f"atlas-{size[0]}x{size[1]}"
+        self.data_path = os.path.join(cache_path, name + ".rgb")
+        self.index_path = os.path.join(cache_path, name + ".json")
+        # key -> [slot, source mtime in ns]
+        self.index = {}
+        self.mm = None
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            with open(self.index_path) as f:
+                self.index = json.loads(f.read())
+            self.map()
+
+    def map(self):
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # Some thumbnail still points into it, it goes when they do
+                pass
+        if os.path.getsize(self.data_path) == 0:
+            self.mm = None
+            return
+        with open(self.data_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Make sure the atlas holds an up to date thumbnail for every
+    # (key, path) given, decoding only what's new or changed since last time.
+    # A source that's gone keeps whatever thumbnail it had, or gets a placeholder.
+    def sync(self, sources):
+        stale = []
+        for key, path in sources:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                if key not in self.index:
+                    stale.append((key, None, MISSING))
+                continue
+            entry = self.index.get(key)
+            if entry is None or entry[1] != mtime:
+                stale.append((key, path, mtime))
+        if not stale:
+            return 0
+
+        next_slot = max((e[0] for e in self.index.values()), default=-1) + 1
+        mode = "r+b" if os.path.exists(self.data_path) else "wb"
+        with open(self.data_path, mode) as f:
+            for key, path, mtime in stale:
+                entry = self.index.get(key)
+                if entry is None:
+                    entry = [next_slot, mtime]
+                    next_slot += 1
+                entry[1] = mtime
+                f.seek(entry[0] * self.slot_bytes)
+                f.write(make_thumbnail(path, self.size) if path is not None else make_placeholder(self.size))
+                self.index[key] = entry
+
+        # Written via a temporary file so a crash can't leave a half-written index
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(self.index))
+        os.replace(tmp, self.index_path)
+        self.map()
+        return len(stale)
+
+    def thumbnail(self, key) -> Image.Image:
+        slot = self.index[key][0] * self.slot_bytes
+        view = memoryview(self.mm)[slot:slot + self.slot_bytes]
+        return Image.frombuffer("RGB", self.size, view, "raw", "RGB", 0, 1)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+def row_height(size=THUMB_SIZE):
+    return size[1] + PADDING * 2
+
+# Draws one tier: the label on the left, then its thumbnails wrapping at `per_row`
+def render_tier(atlas: Atlas, name: str, keys, per_row: int) -> Image.Image:
+    w, h = atlas.size
+    rows = max(1, -(-len(keys) // per_row))
+    im = Image.new("RGB", (LABEL_WIDTH + per_row * (w + PADDING) + PADDING, rows * row_height(atlas.size)), BACKGROUND)
+
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((0, 0, LABEL_WIDTH - 1, im.height - 1), fill=TIER_COLOURS.get(name, (200, 200, 200)))
+    font = ImageFont.load_default(size=32)
+    left, top, right, bottom = draw.textbbox((0, 0), name, font=font)
+    draw.text(((LABEL_WIDTH - (right - left)) // 2, (im.height - (bottom - top)) // 2), name, fill=(0, 0, 0), font=font)
+
+    for i, key in enumerate(keys):
+        row, col = divmod(i, per_row)
+        im.paste(atlas.thumbnail(key), (LABEL_WIDTH + PADDING + col * (w + PADDING), PADDING + row * row_height(atlas.size)))
+    return im
+
+# For the process pool: each worker maps the atlas itself rather than being sent pixels
+def render_tier_worker(cache_path, size, name, keys, per_row):
+    atlas = Atlas(cache_path, size)
+    try:
+        im = render_tier(atlas, name, keys, per_row)
+        return im.size, im.tobytes()
+    finally:
+        atlas.close()
+
+# Draws a whole tier list as a JPEG.
+#
+# tiers is [(tier name, [atlas key, ...]), ...], best tier first. With workers
+# set, tiers are drawn in that many processes - only worth it for very big grids.
+def render(atlas: Atlas, tiers, per_row: int = 12, workers: int = None) -> io.BytesIO:
+    if workers:
+        cache_path = os.path.dirname(atlas.data_path)
+        with ProcessPoolExecutor(workers) as pool:
+            futs = [pool.submit(render_tier_worker, cache_path, atlas.size, name, keys, per_row) for name, keys in tiers]
+            strips = [Image.frombytes("RGB", size, data) for size, data in (f.result() for f in futs)]
+    else:
+        strips = [render_tier(atlas, name, keys, per_row) for name, keys in tiers]
+
+    out = Image.new("RGB", (max(s.width for s in strips), sum(s.height for s in strips) + PADDING * (len(strips) - 1)), BACKGROUND)
+    y = 0
+    for strip in strips:
+        out.paste(strip, (0, y))
+        y += strip.height + PADDING
+
+    buf = io.BytesIO()
+    # Thumbnails are photo-like, so JPEG is both far smaller and far quicker than PNG here
+    out.save(buf, format="JPEG", quality=85)
+    buf.seek(0)
+    return buf
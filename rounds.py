@@ -0,0 +1,49 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+class Busy(Exception):
+    pass
+
+# Hands out one asyncio lock per channel, so a slow /start in one channel
+# never holds up a /stop somewhere else, and nothing ever blocks the event loop.
+class RoundCoordinator:
+    def __init__(self):
+        self.locks = {}
+        # Channels with a round currently open for voting
+        self.in_progress = set()
+
+    def lock_for(self, key) -> asyncio.Lock:
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[key] = lock
+        return lock
+
+    def busy(self, key) -> bool:
+        return self.lock_for(key).locked()
+
+    # Holds the lock for `key` for the duration of the block.
+    #
+    # With wait=False a held lock raises Busy straight away instead of queueing.
+    # With wait=True callers queue up in FIFO order (asyncio.Lock is fair),
+    # giving up with Busy after `timeout` seconds if one is set.
+    #
+    # The lock is always released on the way out, even if the block raises.
+    @asynccontextmanager
+    async def hold(self, key, wait: bool = False, timeout: float = None):
+        lock = self.lock_for(key)
+        if not wait:
+            if lock.locked():
+                raise Busy(key)
+            # An uncontended acquire doesn't yield, so nobody can sneak in
+            # between the check above and taking the lock
+            await lock.acquire()
+        else:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise Busy(key)
+        try:
+            yield
+        finally:
+            lock.release()
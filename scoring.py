@@ -0,0 +1,90 @@
+from math import ceil, floor
+from typing import NamedTuple
+
+import numpy as np
+
+# Scoring for whole batches of things at once.
+#
+# Everything takes an (items x scores) histogram matrix, where row i column j
+# holds how many votes item i got for score j+1 - the same shape as a row of
+# votes/map_votes/sleeve_votes, stacked.
+
+# We want to round half upwards, so here is a helper
+def normal_round(n):
+    if n - floor(n) < 0.5:
+        return floor(n)
+    return ceil(n)
+
+# normal_round, for arrays
+def normal_round_all(n):
+    down = np.floor(n)
+    return np.where(n - down < 0.5, down, np.ceil(n))
+
+class Scores(NamedTuple):
+    # Votes taken off each end
+    removed: np.ndarray
+    # Sum of score * votes over what was left
+    total: np.ndarray
+    average: np.ndarray
+
+def as_matrix(hists) -> np.ndarray:
+    m = np.asarray(hists, dtype=np.int64)
+    if m.ndim == 1:
+        m = m.reshape(1, -1)
+    return m
+
+# Take `removed[i]` votes off the low end of each row
+def trim_low(m, removed):
+    before = np.cumsum(m, axis=1) - m
+    return m - np.clip(removed[:, None] - before, 0, m)
+
+# Computes the weighted average of every row after removing the top and
+# bottom `trim` of its votes. A trim of 0 keeps every vote; half or more
+# would leave nothing, so that's refused.
+def trimmed_means(hists, trim: float = 0.1) -> Scores:
+    if not 0 <= trim < 0.5:
+        raise ValueError(f"trim must be at least 0 and less than 0.5, not {trim}")
+    m = as_matrix(hists)
+    votes = m.sum(axis=1)
+
+    # The default trim divides by 10, so it does exactly what it always has
+    # (votes/10 and votes*0.1 don't always agree in floating point)
+    share = votes / 10 if trim == 0.1 else votes * trim
+    removed = normal_round_all(share + 0.01).astype(np.int64)
+
+    left = trim_low(m, removed)
+    left = trim_low(left[:, ::-1], removed)[:, ::-1]
+
+    weights = np.arange(1, m.shape[1] + 1, dtype=np.int64)
+    total = left @ weights
+
+    counted = votes - removed * 2
+    average = np.divide(total, counted, out=np.zeros(len(m)), where=counted > 0)
+
+    # Nothing to go on, so nothing to report
+    empty = votes == 0
+    removed[empty] = 0
+    total[empty] = 0
+    return Scores(removed, total, average)
+
+# The plain average, pulled towards `prior` (the mean of every vote in the
+# batch, by default) as if everything had `weight` extra votes of that.
+# Handy for ranking things with very few votes.
+def bayesian_averages(hists, weight: float = 5, prior: float = None) -> np.ndarray:
+    m = as_matrix(hists)
+    weights = np.arange(1, m.shape[1] + 1, dtype=np.int64)
+    votes = m.sum(axis=1)
+    sums = m @ weights
+    if prior is None:
+        prior = sums.sum() / votes.sum() if votes.sum() else 0.0
+    return (weight * prior + sums) / (weight + votes)
+
+# Computes the weighted average of the list after removing
+# the top and bottom 10% of votes.
+#
+# Returns (votes removed from each end, total after removal, average)
+def weighted_average(lst, trim: float = 0.1):
+    if sum(lst) == 0:
+        return (0, 0, 0)
+    removed, total, average = trimmed_means([lst], trim)
+    return (int(removed[0]), int(total[0]), float(average[0]))
@@ -1,49 +1,214 @@
 from bs4 import BeautifulSoup
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse
+import argparse
+import hashlib
 import json
+import os
+import sys
+import threading
 import time
 
-root = "https://splatoonwiki.org"
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Point this somewhere else (e.g. a local `python -m http.server` full of
+# saved pages) to run against fixtures instead of the real wiki
+root = os.getenv("SCRAPE_ROOT", "https://splatoonwiki.org")
 parent_endpoint = "/wiki/Tableturf_Battle"
 
-def get(s: str):
-    print(f"GET {s}")
-    time.sleep(0.1)
-    return requests.get(s)
+class FetchError(Exception):
+    pass
 
-def main():
-    resp = get(root + parent_endpoint)
-    if resp.status_code != 200:
-        print(f"non-200 code: {resp.status_code}")
-        return
-    soup = BeautifulSoup(resp.content, features="html.parser")
+# A polite, caching HTTP client.
+#
+# - One pooled session shared by every worker thread.
+# - At most `per_host` requests in flight to any one host, at least `delay`
+#   seconds apart.
+# - Connection errors, 429s and 5xxs are retried with exponential backoff,
+#   honouring Retry-After.
+# - Every response is saved under cache_dir with its ETag/Last-Modified, and
+#   sent back as If-None-Match/If-Modified-Since next time, so a rerun only
+#   downloads what changed. With offline=True the network isn't touched at
+#   all and everything is served from that cache - recorded responses.
+class Fetcher:
+    def __init__(self, cache_dir: str, workers: int = 8, per_host: int = 2, delay: float = 0.1, offline: bool = False):
+        self.cache_dir = cache_dir
+        self.per_host = per_host
+        self.delay = delay
+        self.offline = offline
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        # host -> semaphore limiting requests in flight
+        self.slots = {}
+        # host -> earliest time the next request may start
+        self.next_at = {}
+
+        self.fetched = 0
+        self.revalidated = 0
+
+    def paths(self, url: str):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json"), os.path.join(self.cache_dir, key + ".body")
+
+    def cached(self, url: str):
+        meta_path, body_path = self.paths(url)
+        if not os.path.exists(meta_path) or not os.path.exists(body_path):
+            return None, None
+        with open(meta_path) as f:
+            meta = json.loads(f.read())
+        with open(body_path, "rb") as f:
+            return meta, f.read()
+
+    def store(self, url: str, resp: requests.Response):
+        meta_path, body_path = self.paths(url)
+        meta = {
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
+        # Body first, so the metadata never points at a body that isn't there
+        for path, mode, data in [(body_path, "wb", resp.content), (meta_path, "w", json.dumps(meta))]:
+            with open(path + ".tmp", mode) as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+
+    # Wait for our turn at the host
+    def acquire(self, host: str):
+        with self.lock:
+            slot = self.slots.setdefault(host, threading.Semaphore(self.per_host))
+        slot.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_at.get(host, 0))
+            self.next_at[host] = start + self.delay
+        time.sleep(start - now)
+        return slot
+
+    def get(self, url: str) -> bytes:
+        meta, body = self.cached(url)
+        if self.offline:
+            if body is None:
+                raise FetchError(f"not cached: {url}")
+            return body
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        slot = self.acquire(urlparse(url).netloc)
+        try:
+            print(f"GET {url}")
+            resp = self.session.get(url, headers=headers, timeout=30)
+        except requests.RequestException as e:
+            raise FetchError(f"{url}: {e}")
+        finally:
+            slot.release()
+
+        if resp.status_code == 304 and body is not None:
+            self.revalidated += 1
+            return body
+        if resp.status_code != 200:
+            raise FetchError(f"non-200 code for {url}: {resp.status_code}")
+        self.fetched += 1
+        self.store(url, resp)
+        return resp.content
+
+# [(index, name, file page link), ...] for every sleeve in the gallery
+def list_sleeves(page: bytes):
+    soup = BeautifulSoup(page, features="html.parser")
     start = soup.find(id="Sleeves")
     inner = u""
-    for elt in start.parent.nextSiblingGenerator():
+    for elt in start.parent.next_siblings:
         if elt.name == "h3":
             break
         inner += str(elt)
     soup = BeautifulSoup(inner, features="html.parser")
-    out = {}
+    out = []
     for idx, it in enumerate(soup.find_all("li", attrs={"class": "gallerybox"})):
         for (nametag, linktag) in zip(it.find_all("div", attrs={"class":"gallerytext"}), it.find_all("a", href=True)):
-            out[idx] = {"name": nametag.p.text.strip()}
-            nxt = get(root + linktag["href"])
-            if nxt.status_code != 200:
-                print(f"non 200 code for {linktag['href']} {nxt.status_code}")
-                return
-            nxtSoup = BeautifulSoup(nxt.content, features="html.parser")
-            for tag in nxtSoup.find_all("div", attrs={"class":"fullImageLink", "id": "file"}):
-                actual_image_link = tag.a["href"]
-                r = get(actual_image_link.replace("//", "https://"))
-                if r.status_code != 200:
-                    print(f"non 200 code for {actual_image_link}")
-                    return
-                with open(f"gallery/sleeve_{idx}.png", "wb") as f:
-                    f.write(r.content)
+            out.append((idx, nametag.p.text.strip(), linktag["href"]))
+    return out
+
+def fetch_sleeve(fetcher: Fetcher, base: str, gallery: str, idx: int, href: str):
+    page_url = urljoin(base, href)
+    soup = BeautifulSoup(fetcher.get(page_url), features="html.parser")
+    for tag in soup.find_all("div", attrs={"class":"fullImageLink", "id": "file"}):
+        # Links are protocol-relative ("//cdn..."), which urljoin resolves against root's scheme
+        data = fetcher.get(urljoin(page_url, tag.a["href"]))
+        path = os.path.join(gallery, f"sleeve_{idx}.png")
+        # Leave unchanged images alone, so their mtimes (and anything cached off them) stay put
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    continue
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrape card sleeves from the Splatoon wiki.")
+    parser.add_argument("--root", default=root, help="wiki to scrape, e.g. a local fixture server")
+    parser.add_argument("--cache", default=".scrape_cache", help="where to keep fetched pages")
+    parser.add_argument("--gallery", default="gallery")
+    parser.add_argument("--manifest", default="sleeve_manifest.json")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--per-host", type=int, default=2, help="most requests in flight to one host")
+    parser.add_argument("--delay", type=float, default=0.1, help="least seconds between requests to one host")
+    parser.add_argument("--offline", action="store_true", help="only use what's already cached")
+    args = parser.parse_args()
+
+    fetcher = Fetcher(args.cache, args.workers, args.per_host, args.delay, args.offline)
+    try:
+        sleeves = list_sleeves(fetcher.get(args.root + parent_endpoint))
+    except FetchError as e:
+        print(e)
+        return 1
+
+    previous = {}
+    if os.path.exists(args.manifest):
+        with open(args.manifest) as f:
+            previous = json.loads(f.read())
+
+    out = {}
+    failed = []
+    with ThreadPoolExecutor(args.workers) as pool:
+        futs = {pool.submit(fetch_sleeve, fetcher, args.root, args.gallery, idx, href): (idx, name) for idx, name, href in sleeves}
+        for fut, (idx, name) in futs.items():
+            try:
+                fut.result()
+                out[idx] = {"name": name}
+            except FetchError as e:
+                # Carry on with the rest, one bad page shouldn't throw away the whole run.
+                # Whatever we had for it last time is still good.
+                print(e)
+                failed.append(name)
+                if str(idx) in previous:
+                    out[idx] = previous[str(idx)]
+
     # TODO: manually change the names of a few cards...
-    with open("sleeve_manifest.json", "w") as f:
-        f.write(json.dumps(out, indent=4))
+    with open(args.manifest + ".tmp", "w") as f:
+        f.write(json.dumps(dict(sorted(out.items())), indent=4))
+    os.replace(args.manifest + ".tmp", args.manifest)
+
+    print(f"{fetcher.fetched} fetched, {fetcher.revalidated} unchanged, {len(failed)} failed")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
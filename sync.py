@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+
+from manifest_gen import resolve_cost
+
+# Keeps the manifests in step with the gallery without redoing everything.
+#
+# An index of every gallery file and manifest (size, mtime and content hash)
+# is kept between runs. Only files whose size or mtime moved get hashed again,
+# and only files whose hash moved get processed. Whatever that changes in the
+# manifests is written out as a diff, which the bot's /sync command applies to
+# a running bot - no restart, no full re-ingest.
+#
+# The diff looks like:
+#
+#     {"card": {"upsert": {"12": {"name": ..., "rarity": ..., "cost": ...}}, "remove": ["40"]}, "map": {...}, "sleeve": {...}}
+
+new_card = re.compile(r"No. (\d+) (.*) \((.*)\).jpg")
+
+def write_atomic(path: str, data: str):
+    with open(path + ".tmp", "w") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Index:
+    def __init__(self, path: str):
+        self.path = path
+        # file path -> {"size", "mtime_ns", "sha256"}
+        self.files = {}
+        # manifest path -> contents as of the last sync
+        self.manifests = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.loads(f.read())
+            self.files = saved["files"]
+            self.manifests = saved["manifests"]
+
+    # The hash of a file, reusing the last one if size and mtime haven't moved
+    def hash(self, path: str) -> str:
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["sha256"]
+        digest = file_hash(path)
+        self.files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def save(self):
+        write_atomic(self.path, json.dumps({"files": self.files, "manifests": self.manifests}))
+
+# {"upsert": {...}, "remove": [...]} taking `old` to `new`
+def diff_manifest(old: dict, new: dict) -> dict:
+    return {
+        "upsert": {k: v for k, v in new.items() if old.get(k) != v},
+        "remove": sorted(k for k in old if k not in new),
+    }
+
+def load_manifest(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.loads(f.read())
+
+# Brings the gallery and manifests up to date, returning
+# (diff, changed image paths)
+def sync(gallery: str, manifests: dict, index: Index):
+    changed_images = []
+    card_manifest = load_manifest(manifests["card"])
+
+    seen = set()
+    for fname in sorted(os.listdir(gallery)):
+        path = os.path.join(gallery, fname)
+        if not os.path.isfile(path) or fname.startswith("."):
+            continue
+
+        # Freshly downloaded cards come named after themselves: add them and
+        # give them their number as a name, like manifest_gen does
+        result = new_card.match(fname)
+        if result:
+            number = str(int(result.group(1)))
+            name = result.group(2)
+            cost, listed, how = resolve_cost(name)
+            if how is None:
+                print(f"no cost known for {name!r} ({fname}), check the lists in manifest_gen.py")
+            elif how == "fuzzy":
+                print(f"guessed {name!r} ({fname}) is {listed!r}, cost {cost}")
+            card_manifest[number] = {
+                "name": name,
+                "rarity": result.group(3),
+                "cost": cost,
+            }
+            renamed = os.path.join(gallery, f"{number}.jpg")
+            os.replace(path, renamed)
+            path = renamed
+
+        seen.add(path)
+        old = index.files.get(path, {}).get("sha256")
+        if index.hash(path) != old and old is not None:
+            changed_images.append(path)
+
+    # Cards whose images are gone are gone too
+    for path in [p for p in index.files if p.startswith(gallery + os.sep) and p not in seen]:
+        del index.files[path]
+        number = os.path.splitext(os.path.basename(path))[0]
+        if number.isdigit():
+            card_manifest.pop(number, None)
+        changed_images.append(path)
+
+    if card_manifest != load_manifest(manifests["card"]):
+        write_atomic(manifests["card"], json.dumps(card_manifest, indent=4, sort_keys=True))
+
+    diff = {}
+    for typ, path in manifests.items():
+        if not os.path.exists(path):
+            continue
+        digest = index.hash(path)
+        previous = index.manifests.get(path)
+        if previous is not None and previous["sha256"] == digest:
+            diff[typ] = {"upsert": {}, "remove": []}
+            continue
+        current = load_manifest(path)
+        diff[typ] = diff_manifest(previous["contents"] if previous else {}, current)
+        index.manifests[path] = {"sha256": digest, "contents": current}
+
+    return diff, changed_images
+
+def main():
+    parser = argparse.ArgumentParser(description="Bring the manifests up to date with the gallery, and write down what changed.")
+    parser.add_argument("--gallery", default="gallery")
+    parser.add_argument("--manifest", default="manifest.json")
+    parser.add_argument("--mapifest", default="mapifest.json")
+    parser.add_argument("--sleeve-manifest", default="sleeve_manifest.json")
+    parser.add_argument("--index", default=".gallery_index.json", help="where to remember what was seen last time")
+    parser.add_argument("--diff", default="manifest_diff.json", help="where to write the changes, for /sync")
+    args = parser.parse_args()
+
+    index = Index(args.index)
+    diff, changed_images = sync(args.gallery, {
+        "card": args.manifest,
+        "map": args.mapifest,
+        "sleeve": args.sleeve_manifest,
+    }, index)
+
+    # Changes pile up until the bot applies them
+    pending = load_manifest(args.diff)
+    for typ, changes in diff.items():
+        merged = pending.setdefault(typ, {"upsert": {}, "remove": []})
+        for number in changes["remove"]:
+            merged["upsert"].pop(number, None)
+        merged["remove"] = sorted(set(merged["remove"]) - set(changes["upsert"]) | set(changes["remove"]))
+        merged["upsert"].update(changes["upsert"])
+    pending["images"] = sorted(set(pending.get("images", [])) | set(changed_images))
+
+    write_atomic(args.diff, json.dumps(pending, indent=4))
+    index.save()
+
+    for typ, changes in diff.items():
+        print(f"{typ}: {len(changes['upsert'])} added or changed, {len(changes['remove'])} removed")
+    print(f"{len(changed_images)} images changed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Running vote counts for every in-flight message, kept up to date from
+# reaction events as they happen, so a round's results are known without
+# asking Discord for them.
+#
+# Votes are kept per user: everyone gets one score per message, and if they
+# react more than once their latest reaction is the one that counts. Take that
+# one away and whichever of their reactions is left, latest first, counts instead.
+#
+# Histograms are lists of counts where index i holds the votes for score i+1,
+# the same shape the DB stores. They're derived from the ballots, and kept
+# up to date alongside them rather than recounted.
+class TallyEngine:
+    def __init__(self):
+        # message id -> histogram
+        self.hists = {}
+        # message id -> (type, number)
+        self.things = {}
+        # message id -> {user id: [scores they've reacted with, oldest first]}
+        self.ballots = {}
+        # (message id, user id) changed since the last checkpoint
+        self.dirty = set()
+        # message id -> user ids whose ballot came from a checkpoint, which
+        # only has the score that counted, until the message is reconciled
+        self.restored = {}
+
+    def __contains__(self, message_id):
+        return message_id in self.hists
+
+    # Start counting for a message. Does nothing if we already are, so it is
+    # safe to call again after a reconnect.
+    def track(self, message_id, max_vote, type, number, ballots=None):
+        if message_id in self.hists:
+            return
+        self.hists[message_id] = [0]*max_vote
+        self.things[message_id] = (type, number)
+        self.ballots[message_id] = {}
+        for user_id, score in (ballots or {}).items():
+            self.vote(message_id, user_id, [score], dirty=False)
+        if ballots:
+            self.restored[message_id] = set(ballots)
+
+    def forget(self, message_id):
+        self.hists.pop(message_id, None)
+        self.things.pop(message_id, None)
+        self.ballots.pop(message_id, None)
+        self.restored.pop(message_id, None)
+        self.dirty = {d for d in self.dirty if d[0] != message_id}
+
+    # Set a user's reactions on a message, keeping the histogram in step
+    def vote(self, message_id, user_id, scores, dirty=True):
+        hist = self.hists.get(message_id)
+        if hist is None:
+            return
+        scores = [s for s in scores if 1 <= s <= len(hist)]
+        users = self.ballots[message_id]
+        old = users[user_id][-1] if users.get(user_id) else None
+        new = scores[-1] if scores else None
+        if scores:
+            users[user_id] = scores
+        else:
+            users.pop(user_id, None)
+        if old == new:
+            return
+        if old is not None:
+            hist[old-1] -= 1
+        if new is not None:
+            hist[new-1] += 1
+        if dirty:
+            self.dirty.add((message_id, user_id))
+
+    def add(self, message_id, user_id, score):
+        users = self.ballots.get(message_id)
+        if users is None:
+            return
+        scores = [s for s in users.get(user_id, []) if s != score]
+        self.vote(message_id, user_id, scores + [score])
+
+    def remove(self, message_id, user_id, score):
+        users = self.ballots.get(message_id)
+        if users is None:
+            return
+        self.vote(message_id, user_id, [s for s in users.get(user_id, []) if s != score])
+
+    # Bring a message in line with what's actually on it, given as
+    # {user id: {scores}}. Reactions we already knew about keep their order,
+    # anything new is treated as more recent - except for ballots restored from
+    # a checkpoint, where the other reactions were most likely there already
+    # and just weren't saved, so the score that counted keeps counting.
+    def reconcile(self, message_id, present):
+        users = self.ballots.get(message_id)
+        if users is None:
+            return
+        restored = self.restored.pop(message_id, set())
+        for user_id in set(users) | set(present):
+            now = present.get(user_id, set())
+            kept = [s for s in users.get(user_id, []) if s in now]
+            added = sorted(now - set(kept))
+            self.vote(message_id, user_id, added + kept if user_id in restored else kept + added)
+
+    def histogram(self, message_id):
+        hist = self.hists.get(message_id)
+        return None if hist is None else hist.copy()
+
+    def voters(self, message_id) -> int:
+        return len(self.ballots.get(message_id, {}))
+
+    # Rows of (message id, user id, type, number, score) for every ballot
+    # changed since the last call, score being None if it was withdrawn.
+    # Only for the given messages if message_ids is set.
+    #
+    # Hand them back with mark_dirty if saving them fails.
+    def take_dirty(self, message_ids=None):
+        taken = {d for d in self.dirty if message_ids is None or d[0] in message_ids}
+        self.dirty -= taken
+        rows = []
+        for message_id, user_id in taken:
+            type, number = self.things[message_id]
+            scores = self.ballots[message_id].get(user_id)
+            rows.append((message_id, user_id, type, number, scores[-1] if scores else None))
+        return taken, rows
+
+    def mark_dirty(self, taken):
+        self.dirty.update(d for d in taken if d[0] in self.hists)
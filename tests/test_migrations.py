@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+import migrations
+from db import DB, SCHEMA_VERSION
+
+CARDS = 300
+CHANNEL = 555
+FORUM = 777
+
+# The tables as the first version of the bot made them, before schema versions were kept
+BASELINE_SCHEMA = [
+    "CREATE TABLE cards(number INTEGER PRIMARY KEY, name VARCHAR(255), cost INTEGER, rarity VARCHAR(255), voted INTEGER)",
+    "CREATE TABLE maps(number INTEGER PRIMARY KEY, name VARCHAR(255), voted INTEGER)",
+    "CREATE TABLE sleeves(number INTEGER PRIMARY KEY, name VARCHAR(255), voted INTEGER)",
+    "CREATE TABLE sleeve_votes(number INTEGER, score INTEGER, votes INTEGER, PRIMARY KEY (number, score))",
+    "CREATE TABLE map_votes(number INTEGER, score INTEGER, votes INTEGER, PRIMARY KEY (number, score))",
+    "CREATE TABLE votes(number INTEGER, score INTEGER, votes INTEGER, PRIMARY KEY (number, score))",
+    "CREATE TABLE round_type(thing VARCHAR(255))",
+    "CREATE TABLE messages(channel_id INTEGER, id INTEGER, number INTEGER)",
+    "CREATE TABLE summaries(channel_id INTEGER, id INTEGER)",
+    "CREATE TABLE forum_posts(id INTEGER)",
+    "CREATE TABLE forum_chan(channel_id INTEGER)",
+]
+
+# Cards 1-100 and maps 1-3 have been voted on; a map round is in flight
+def card_votes(number):
+    return [(number + score) % 4 for score in range(10)]
+
+def map_votes(number):
+    return [number, 0, 2, 1, number % 3]
+
+@pytest.fixture
+def baseline(tmp_path):
+    manifests = {
+        "manifest.json": {str(i): {"name": f"Card {i}", "cost": 1 + i % 6, "rarity": "Common"} for i in range(1, CARDS + 1)},
+        "mapifest.json": {str(i): {"name": f"Map {i}"} for i in range(1, 6)},
+        "sleeve_manifest.json": {str(i): {"name": f"Sleeve {i}"} for i in range(3)},
+    }
+    for name, manifest in manifests.items():
+        (tmp_path / name).write_text(json.dumps(manifest))
+
+    path = str(tmp_path / "data.db")
+    conn = sqlite3.connect(path)
+    for sql in BASELINE_SCHEMA:
+        conn.execute(sql)
+    for number, meta in manifests["manifest.json"].items():
+        conn.execute("INSERT INTO cards VALUES(?, ?, ?, ?, ?)", [int(number), meta["name"], meta["cost"], meta["rarity"], int(int(number) <= 100)])
+    for number, meta in manifests["mapifest.json"].items():
+        conn.execute("INSERT INTO maps VALUES(?, ?, ?)", [int(number), meta["name"], int(int(number) <= 3)])
+    for number, meta in manifests["sleeve_manifest.json"].items():
+        conn.execute("INSERT INTO sleeves VALUES(?, ?, 0)", [int(number), meta["name"]])
+    for number in range(1, 101):
+        conn.executemany("INSERT INTO votes VALUES(?, ?, ?)", [(number, score + 1, v) for score, v in enumerate(card_votes(number))])
+    for number in range(1, 4):
+        conn.executemany("INSERT INTO map_votes VALUES(?, ?, ?)", [(number, score + 1, v) for score, v in enumerate(map_votes(number))])
+    conn.execute("INSERT INTO round_type VALUES('map')")
+    conn.executemany("INSERT INTO messages VALUES(?, ?, ?)", [(CHANNEL, 9000 + n, n) for n in (4, 5)])
+    conn.execute("INSERT INTO summaries VALUES(?, 8000)", [CHANNEL])
+    conn.executemany("INSERT INTO forum_posts VALUES(?)", [(7001,), (7002,)])
+    conn.execute("INSERT INTO forum_chan VALUES(?)", [FORUM])
+    conn.commit()
+    conn.close()
+
+    paths = [path] + [str(tmp_path / name) for name in manifests] + [str(tmp_path / "gallery")]
+    return paths
+
+def check_survived(db: DB, guild_id):
+    hists = db.get_histograms(guild_id, "card")
+    assert hists == {n: card_votes(n) for n in range(1, 101)}
+    assert db.get_histograms(guild_id, "map") == {n: map_votes(n) for n in range(1, 4)}
+
+    voted = set(db.conn.execute("SELECT type, number FROM voted WHERE guild_id = ?", [guild_id]))
+    assert voted == {("card", n) for n in range(1, 101)} | {("map", n) for n in range(1, 4)}
+    # Voted things never come up again, nothing else went missing
+    assert len(db.pools(guild_id)["card"]) == CARDS - 100
+    assert set(db.pools(guild_id)["map"].where) == {4, 5}
+
+    assert db.get_forum_chan(guild_id) == FORUM
+    assert db.get_round_type(CHANNEL) == "map"
+    assert sorted(db.get_messages(CHANNEL)) == [(9004, 4), (9005, 5)]
+    assert db.get_summaries(CHANNEL) == [(8000,)]
+    assert sorted(db.get_forum_posts("open")) == [7001, 7002]
+    assert db.catalogue.get("card", 42).name == "Card 42"
+
+def test_baseline_upgrades(baseline):
+    db = DB(*baseline)
+    assert db.stored_meta()["schema_version"] == str(SCHEMA_VERSION)
+    # Nobody's said whose votes these are yet, so they're filed under guild 0
+    check_survived(db, 0)
+    # The old tables still read the same, as views
+    assert db.conn.execute("SELECT COUNT(*) FROM votes").fetchone()[0] == 100 * 10
+    db.conn.close()
+
+    db = DB(*baseline, legacy_guild_id=42)
+    check_survived(db, 42)
+    assert db.get_histograms(0, "card") == {}
+    db.conn.close()
+
+class Interrupted(Exception):
+    pass
+
+def test_interrupted_migration_resumes(baseline, monkeypatch):
+    conn = sqlite3.connect(baseline[0])
+    # Die while copying the fourth chunk of cards
+    set_meta = migrations.set_meta
+    chunks = [0]
+    def dying_set_meta(conn, key, value):
+        if key == "migration:2:cards":
+            chunks[0] += 1
+            if chunks[0] == 4:
+                raise Interrupted
+        set_meta(conn, key, value)
+    monkeypatch.setattr(migrations, "set_meta", dying_set_meta)
+    with pytest.raises(Interrupted):
+        migrations.migrate(conn, migrations.LATEST, chunk_size=20)
+    monkeypatch.undo()
+
+    # Some chunks made it, and the old tables are all still there
+    copied = int(migrations.get_meta(conn, "migration:2:cards"))
+    assert copied == 60
+    assert conn.execute("SELECT COUNT(*) FROM entities WHERE type = 'card'").fetchone()[0] == 60
+    assert migrations.current_version(conn) == 1
+    assert conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0] == CARDS
+
+    assert migrations.migrate(conn, migrations.LATEST, chunk_size=20) == [2, 4, 5]
+    conn.close()
+
+    db = DB(*baseline)
+    check_survived(db, 0)
+    # Nothing copied twice or lost
+    assert db.conn.execute("SELECT COUNT(*) FROM entities WHERE type = 'card'").fetchone()[0] == CARDS
+    db.conn.close()
+
+def test_migrating_twice_does_nothing(baseline):
+    DB(*baseline).conn.close()
+    conn = sqlite3.connect(baseline[0])
+    assert migrations.migrate(conn) == []
+    conn.close()
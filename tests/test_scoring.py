@@ -0,0 +1,91 @@
+import random
+from math import ceil, floor
+
+import pytest
+
+from scoring import trimmed_means, weighted_average
+
+# weighted_average as it was before scoring.py, kept as the oracle: scores
+# already in the database came from this, so the new one has to agree exactly
+def baseline_normal_round(n):
+    if n - floor(n) < 0.5:
+        return floor(n)
+    return ceil(n)
+
+def baseline_weighted_average(lst):
+    total_votes = sum(lst)
+    if total_votes == 0:
+        return (0, 0, 0)
+
+    to_remove = baseline_normal_round((total_votes/10)+0.01)
+
+    def remove(idxs):
+        removed = 0
+        for i in idxs:
+            if lst[i] > 0:
+                if lst[i] > (to_remove - removed):
+                    lst[i] -= (to_remove - removed)
+                    removed = to_remove
+                    break
+                else:
+                    removed += lst[i]
+                    lst[i] = 0
+
+    remove(range(len(lst)))
+    remove(range(len(lst))[::-1])
+
+    s = 0
+    for i in range(len(lst)):
+        s += (i+1)*lst[i]
+
+    return (to_remove, s, s/(total_votes - (to_remove * 2)))
+
+def random_histograms(n, seed=0):
+    rng = random.Random(seed)
+    hists = []
+    for _ in range(n):
+        width = rng.choice([5, 10])
+        # Mostly a realistic handful of voters, sometimes lots, sometimes lopsided
+        voters = rng.choice([rng.randint(0, 30), rng.randint(0, 500)])
+        hist = [0] * width
+        favourite = rng.randrange(width)
+        for _ in range(voters):
+            hist[favourite if rng.random() < 0.3 else rng.randrange(width)] += 1
+        hists.append(hist)
+    return hists
+
+def test_matches_baseline():
+    for hist in random_histograms(20000):
+        assert weighted_average(hist.copy()) == baseline_weighted_average(hist.copy()), hist
+
+def test_batch_matches_one_at_a_time():
+    hists = [h for h in random_histograms(2000, seed=1) if len(h) == 10]
+    removed, total, average = trimmed_means(hists)
+    for i, hist in enumerate(hists):
+        assert (int(removed[i]), int(total[i]), float(average[i])) == (weighted_average(hist) if sum(hist) else (0, 0, 0.0))
+
+@pytest.mark.parametrize("hist, expected", [
+    ([0] * 10, (0, 0, 0)),
+    ([0, 0, 0, 0, 1], (0, 5, 5.0)),
+    # Ten votes takes one off each end
+    ([1, 0, 0, 0, 0, 0, 0, 0, 8, 1], (1, 72, 9.0)),
+    # Five votes rounds half a vote up, so one comes off each end
+    ([1, 1, 1, 1, 1], (1, 9, 3.0)),
+])
+def test_known_values(hist, expected):
+    assert weighted_average(hist.copy()) == expected
+    assert baseline_weighted_average(hist.copy()) == expected
+
+def test_leaves_its_argument_alone():
+    hist = [3, 0, 0, 0, 0, 0, 0, 0, 0, 7]
+    weighted_average(hist)
+    assert hist == [3, 0, 0, 0, 0, 0, 0, 0, 0, 7]
+
+def test_trim_zero_keeps_everything():
+    removed, total, average = trimmed_means([[1, 2, 3, 4, 5]], 0)
+    assert (int(removed[0]), int(total[0]), float(average[0])) == (0, 55, 55 / 15)
+
+@pytest.mark.parametrize("trim", [-0.1, 0.5, 0.9])
+def test_bad_trims_are_refused(trim):
+    with pytest.raises(ValueError):
+        trimmed_means([[1, 2, 3, 4, 5]], trim)
@@ -0,0 +1,140 @@
+import asyncio
+import os
+
+import bot as botmod
+from assets import AssetCache
+from bench import TAGS, make_catalogue
+from db import AsyncDB
+from fakecord import FakeBot, FakeContext, FakeForumChannel, FakeGuild, FakeReactionEvent, FakeTextChannel, Network
+from tally import TallyEngine
+
+MSG = 42
+
+def engine(ballots=None):
+    tally = TallyEngine()
+    tally.track(MSG, 10, "card", 1, ballots)
+    return tally
+
+def test_last_reaction_wins():
+    tally = engine()
+    tally.add(MSG, 1, 3)
+    tally.add(MSG, 1, 7)
+    tally.add(MSG, 2, 7)
+    hist = tally.histogram(MSG)
+    assert hist[3-1] == 0
+    assert hist[7-1] == 2
+    assert tally.voters(MSG) == 2
+
+def test_reacting_again_makes_it_latest():
+    tally = engine()
+    tally.add(MSG, 1, 3)
+    tally.add(MSG, 1, 7)
+    tally.add(MSG, 1, 3)
+    tally.remove(MSG, 1, 3)
+    assert tally.histogram(MSG)[7-1] == 1
+    assert sum(tally.histogram(MSG)) == 1
+
+def test_removing_last_falls_back():
+    tally = engine()
+    for score in (2, 5, 9):
+        tally.add(MSG, 1, score)
+    tally.remove(MSG, 1, 9)
+    assert tally.histogram(MSG)[5-1] == 1
+    # Taking away one that isn't counting changes nothing
+    tally.remove(MSG, 1, 2)
+    assert tally.histogram(MSG)[5-1] == 1
+    tally.remove(MSG, 1, 5)
+    assert sum(tally.histogram(MSG)) == 0
+    assert tally.voters(MSG) == 0
+
+def test_out_of_range_and_untracked_ignored():
+    tally = engine()
+    tally.add(MSG, 1, 11)
+    tally.add(MSG + 1, 1, 3)
+    assert sum(tally.histogram(MSG)) == 0
+    assert tally.histogram(MSG + 1) is None
+
+def test_restored_checkpoint_keeps_its_score():
+    # The checkpoint only has the 7, but the 3 was there all along
+    tally = engine({1: 7})
+    tally.reconcile(MSG, {1: {3, 7}})
+    assert tally.histogram(MSG)[7-1] == 1
+    assert sum(tally.histogram(MSG)) == 1
+    assert not tally.take_dirty()[1]
+    # Once reconciled, its other reactions are in line to fall back to
+    tally.remove(MSG, 1, 7)
+    assert tally.histogram(MSG)[3-1] == 1
+
+def test_reconcile_treats_new_reactions_as_newer():
+    tally = engine()
+    tally.add(MSG, 1, 7)
+    # 4 was added while we weren't listening, 2 is someone we'd never seen
+    tally.reconcile(MSG, {1: {4, 7}, 2: {2}})
+    hist = tally.histogram(MSG)
+    assert hist[4-1] == 1
+    assert hist[7-1] == 0
+    assert hist[2-1] == 1
+
+def test_reconcile_drops_removed_reactions():
+    tally = engine({1: 7, 2: 5})
+    tally.reconcile(MSG, {1: {3}})
+    hist = tally.histogram(MSG)
+    assert hist[3-1] == 1
+    assert sum(hist) == 1
+    assert sorted(row[1:] for row in tally.take_dirty()[1]) == [(1, "card", 1, 3), (2, "card", 1, None)]
+
+# Through the cog, over fakecord: people vote, the bot goes away, some of
+# them change their minds, and a new bot picks the count back up.
+def test_checkpoint_then_restart(tmp_path):
+    asyncio.run(restart(str(tmp_path)))
+
+def make_cog(bot, db, tmp):
+    return botmod.Poller(bot, db, True, False, os.path.join(tmp, "atlas"), AssetCache(), os.path.join(tmp, "diff.json"))
+
+async def restart(tmp):
+    make_catalogue(tmp, 20)
+    db = AsyncDB(*[os.path.join(tmp, name) for name in ["data.db", "manifest.json", "mapifest.json", "sleeve_manifest.json", "gallery"]])
+    try:
+        net = Network()
+        bot = FakeBot(net)
+        guild = FakeGuild()
+        forum = bot.add_channel(FakeForumChannel(net, tags=TAGS))
+        votes = bot.add_channel(FakeTextChannel(net))
+        await db.set_forum_chan(guild.id, forum.id)
+
+        cog = make_cog(bot, db, tmp)
+        await cog.start.callback(cog, FakeContext(votes, guild), 1, "card")
+        [message] = [m for m in votes.messages.values() if m.reacted]
+        keycap = botmod.reactions(10)
+
+        async def react(cog, user_id, score):
+            message.react(user_id, keycap[score-1])
+            await cog.on_raw_reaction_add(FakeReactionEvent(message, user_id, keycap[score-1]))
+
+        async def unreact(cog, user_id, score):
+            message.unreact(user_id, keycap[score-1])
+            await cog.on_raw_reaction_remove(FakeReactionEvent(message, user_id, keycap[score-1]))
+
+        await react(cog, 1, 3)
+        await react(cog, 1, 7)
+        await react(cog, 2, 5)
+        await react(cog, 3, 9)
+        await unreact(cog, 3, 9)
+        await react(cog, 3, 1)
+        assert cog.tally.histogram(message.id) == [1, 0, 0, 0, 1, 0, 1, 0, 0, 0]
+        await cog.checkpoint_tallies()
+
+        # While nobody was listening: 2 adds a 6 and 3 takes theirs back
+        message.react(2, keycap[6-1])
+        message.unreact(3, keycap[1-1])
+
+        cog = make_cog(bot, db, tmp)
+        await cog.hydrate_tallies()
+        # The checkpoint can't say when the 6 went on, so 2's 5 keeps counting,
+        # as does 1's 7 with the 3 still there
+        assert cog.tally.histogram(message.id) == [0, 0, 0, 0, 1, 0, 1, 0, 0, 0]
+        await unreact(cog, 1, 7)
+        await unreact(cog, 2, 5)
+        assert cog.tally.histogram(message.id) == [0, 0, 1, 0, 0, 1, 0, 0, 0, 0]
+    finally:
+        db.close()
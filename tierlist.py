@@ -0,0 +1,134 @@
+import asyncio
+from bisect import bisect_left, insort
+
+from scoring import trimmed_means
+
+TIER_NAMES = ["S", "A", "B", "C", "D", "F"]
+
+# Lowest average for each tier, as a fraction of the highest possible vote.
+# Anything below the last one is F.
+DEFAULT_THRESHOLDS = [0.8, 0.7, 0.6, 0.5, 0.4]
+
+# Index into TIER_NAMES of the tier `avg` falls in, by thresholds
+def threshold_tier(avg: float, max_vote: int, thresholds=DEFAULT_THRESHOLDS) -> int:
+    tier = 0
+    while tier < len(thresholds) and avg < thresholds[tier] * max_vote:
+        tier += 1
+    return tier
+
+# Something nobody voted on has no score to rank, so it's left out of tiers
+# altogether rather than landing in F
+def has_votes(hist) -> bool:
+    return sum(hist) > 0
+
+# A ranking of everything of one type which has been voted on, best first.
+#
+# Built once from every histogram in a single batched pass, then kept sorted
+# as new scores come in, so neither a new round nor a lookup ever means
+# scoring everything again.
+class TierList:
+    def __init__(self, max_vote: int, hists: dict = None, trim: float = 0.1):
+        self.max_vote = max_vote
+        self.trim = trim
+        # number -> average
+        self.scores = {}
+        # (-average, number), so sorted order is best first
+        self.order = []
+        # mode -> grouped tiers, dropped whenever the ranking changes
+        self.cache = {}
+
+        hists = {n: hist for n, hist in (hists or {}).items() if has_votes(hist)}
+        if hists:
+            numbers = list(hists)
+            averages = trimmed_means([hists[n] for n in numbers], trim).average
+            self.scores = dict(zip(numbers, averages.tolist()))
+            self.order = sorted((-avg, n) for n, avg in self.scores.items())
+
+    def __len__(self):
+        return len(self.order)
+
+    # Add or replace the histogram for one thing
+    def update(self, number, hist):
+        old = self.scores.pop(number, None)
+        if old is not None:
+            del self.order[bisect_left(self.order, (-old, number))]
+        if has_votes(hist):
+            avg = float(trimmed_means([hist], self.trim).average[0])
+            self.scores[number] = avg
+            insort(self.order, (-avg, number))
+        self.cache.clear()
+
+    # [(number, average), ...], best first
+    def ranking(self):
+        return [(n, -avg) for avg, n in self.order]
+
+    # [(tier name, [(number, average), ...]), ...] with every tier present, even if empty.
+    #
+    # "thresholds" buckets by how high the average is, "quantiles" splits the
+    # ranking into equally sized tiers however the scores are spread.
+    def tiers(self, mode: str = "thresholds", thresholds=DEFAULT_THRESHOLDS):
+        key = (mode, tuple(thresholds))
+        if key not in self.cache:
+            if mode == "quantiles":
+                self.cache[key] = self.by_quantile()
+            else:
+                self.cache[key] = self.by_threshold(thresholds)
+        return self.cache[key]
+
+    def by_threshold(self, thresholds):
+        out = [(name, []) for name in TIER_NAMES[:len(thresholds)+1]]
+        for number, avg in self.ranking():
+            out[threshold_tier(avg, self.max_vote, thresholds)][1].append((number, avg))
+        return out
+
+    def by_quantile(self):
+        ranking = self.ranking()
+        n = len(TIER_NAMES)
+        out = []
+        for i, name in enumerate(TIER_NAMES):
+            out.append((name, ranking[len(ranking)*i//n:len(ranking)*(i+1)//n]))
+        return out
+
+# One TierList per guild and type, each loaded from the database the first time it's asked for
+class TierCache:
+    def __init__(self, db, trim: float = 0.1):
+        self.db = db
+        self.trim = trim
+        # (guild id, type) -> TierList
+        self.lists = {}
+        # (guild id, type) -> scores recorded while it was being loaded
+        self.loading = {}
+        # (guild id, type) -> set once whoever's loading it is done, however that went
+        self.loaded = {}
+
+    async def get(self, guild_id, type: str, max_vote: int) -> TierList:
+        key = (guild_id, type)
+        while key not in self.lists:
+            if key in self.loading:
+                # Someone else is already loading it. If that fails, go round
+                # and have a go ourselves.
+                await self.loaded[key].wait()
+                continue
+            self.loading[key] = []
+            self.loaded[key] = asyncio.Event()
+            try:
+                hists = await self.db.get_histograms(guild_id, type)
+                tiers = TierList(max_vote, hists, self.trim)
+                # The read may have raced a round finishing, so replay anything
+                # recorded in the meantime on top
+                for number, hist in self.loading[key]:
+                    tiers.update(number, hist)
+                self.lists[key] = tiers
+            finally:
+                del self.loading[key]
+                self.loaded.pop(key).set()
+        return self.lists[key]
+
+    # Fold newly recorded scores in. Nothing to do if that list hasn't been
+    # loaded yet, since loading it will pick them up from the database anyway.
+    def record(self, guild_id, type: str, number, hist):
+        key = (guild_id, type)
+        if key in self.lists:
+            self.lists[key].update(number, hist)
+        elif key in self.loading:
+            self.loading[key].append((number, hist))